@@ -0,0 +1,231 @@
+# This script measures how speciesSummary.py scales with the number of records.
+#
+# For each requested size it generates (or reuses) a synthetic csv file shaped like a
+# BirdTrack export, runs speciesSummary.py over it and collects the time and memory used
+# by each stage of the run (load, normalise, summary, per-species, calendar, breeding,
+# visitors, merge and excel or bundle write) with each requested output format.  The
+# results are written to a JSON report that can be compared with the report from another
+# version using --baseline_report_path.
+#
+# The synthetic records are generated from a fixed seed so every run sees the same data:
+#
+# - species frequencies follow a Zipf-like skew, a few species have most of the records
+# - sub species, species to ignore and 'Unidentified' names are included so the
+#   normalisation stage has work to do
+# - summer and winter visitors are only recorded in their season
+# - places and observers are skewed towards a popular few and each place sits in a fixed
+#   1km square
+# - most records have no breeding status, the rest are spread over the decoded statuses
+# - most counts are small with the occasional large flock
+#
+# As input the script can take the following arguments - all optional:
+#
+# - The record counts to benchmark (default 10k, 100k, 1M and 10M)
+# - The seed for the generator
+# - The number of years the records span
+# - The folder in which to keep the generated files
+# - The chunksize to pass to speciesSummary.py
+# - The output formats of speciesSummary.py to benchmark (default excel)
+# - Whether to trace the memory allocated within each stage (slower)
+# - The file path for the JSON report and the file path of a report to compare against
+
+import argparse
+import json
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from summaryWriter import outputFormats
+
+species = ['Woodpigeon', 'Blackbird', 'Robin', 'Carrion Crow', 'Magpie', 'Wren', 'Blue Tit',
+           'Chaffinch', 'Great Tit', 'House Sparrow', 'Starling', 'Buzzard', 'Jackdaw',
+           'Goldfinch', 'Dunnock', 'Mallard', 'Herring Gull', 'Black-headed Gull', 'Long-tailed Tit',
+           'Song Thrush', 'Grey Heron', 'Collared Dove', 'Coal Tit', 'Pied Wagtail', 'Rook',
+           'Goldcrest', 'Great Spotted Woodpecker', 'Bullfinch', 'Greenfinch', 'Siskin', 'Mute Swan',
+           'Lesser Black-backed Gull', 'Cormorant', 'Oystercatcher', 'Curlew', 'Redshank',
+           'Lapwing', 'Moorhen', 'Coot', 'Tufted Duck', 'Teal', 'Goosander', 'Dipper',
+           'Grey Wagtail', 'Kestrel', 'Sparrowhawk', 'Raven', 'Meadow Pipit', 'Skylark',
+           'Reed Bunting', 'Stonechat', 'Linnet', 'Treecreeper', 'Nuthatch', 'Jay', 'Feral Pigeon',
+           'Little Grebe', 'Great Crested Grebe', 'Kingfisher', 'Tawny Owl', 'Peregrine', 'Snipe',
+           'Woodcock', 'Water Rail', 'Shelduck', 'Eider', 'Red-breasted Merganser', 'Shag',
+           'Black Guillemot', 'Gannet', 'Kittiwake', 'Common Gull', 'Dunlin', 'Knot', 'Golden Plover',
+           'Blackbird (merula)', 'Chaffinch (coelebs)', 'Robin (melophilus)', 'Woodpigeon (palumbus)',
+           'Cormorant (Continental - sinensis)', 'Rock Dove', 'Common/Lesser Redpoll',
+           'Domestic Mallard', 'Hybrid duck', 'Unidentified gull', 'Unidentified wader']
+
+summerVisitors = ['Swallow', 'Willow Warbler', 'Chiffchaff', 'Blackcap', 'House Martin', 'Swift',
+                  'Sand Martin', 'Sedge Warbler', 'Whitethroat', 'Common Sandpiper', 'Wheatear',
+                  'Osprey', 'Cuckoo', 'Grasshopper Warbler', 'Garden Warbler', 'Tree Pipit',
+                  'Spotted Flycatcher', 'Redstart', 'Whinchat', 'Common Tern']
+
+winterVisitors = ['Redwing', 'Fieldfare', 'Pink-footed Goose', 'Whooper Swan', 'Goldeneye',
+                  'Brambling', 'Long-tailed Duck', 'Turnstone', 'Waxwing', 'Jack Snipe',
+                  'Greenshank', 'Iceland Gull', 'Barnacle Goose', 'Pintail']
+
+breedingStatuses = [None, 'Non-breeding', 'Possible breeder', 'Probable breeding', 'Confirmed breeding']
+breedingWeights = [0.70, 0.15, 0.08, 0.04, 0.03]
+
+places = 2000
+observers = 600
+blockSize = 1000000
+
+def zipfWeights(n, exponent):
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+def generateRecords(rows, rng, years, firstYear=2014):
+    # Generate a block of synthetic BirdTrack export rows
+    allSpecies = np.array(species + summerVisitors + winterVisitors)
+    # interleave the visitors into the frequency ranking rather than making them all rare
+    ranking = np.random.default_rng(0).permutation(len(allSpecies))
+    speciesIndex = ranking[rng.choice(len(allSpecies), rows, p=zipfWeights(len(allSpecies), 1.1))]
+    speciesNames = allSpecies[speciesIndex]
+
+    # BOU order follows a fixed shuffle of the species so that it is not just the ranking
+    bouOrder = np.random.default_rng(1).permutation(len(allSpecies)) * 10 + 100
+
+    # Dates - residents all year, summer visitors April to September and winter visitors
+    # October to March
+    year = firstYear + rng.integers(0, years, rows)
+    dayOfYear = rng.integers(0, 365, rows)
+    summer = np.isin(speciesNames, summerVisitors)
+    winter = np.isin(speciesNames, winterVisitors)
+    dayOfYear[summer] = rng.integers(90, 273, summer.sum())
+    dayOfYear[winter] = (rng.integers(273, 455, winter.sum())) % 365
+    dates = pd.to_datetime(year.astype(str), format='%Y') + pd.to_timedelta(dayOfYear, unit='D')
+
+    # Places sit in a fixed 1km square, both places and observers are skewed
+    place = rng.choice(places, rows, p=zipfWeights(places, 0.9))
+    placeRng = np.random.default_rng(2)
+    placeEasting = placeRng.integers(20, 80, places)
+    placeNorthing = placeRng.integers(40, 90, places)
+    gridRef = np.char.add(np.char.add('NS', placeEasting[place].astype(str)), placeNorthing[place].astype(str))
+    observer = rng.choice(observers, rows, p=zipfWeights(observers, 1.0))
+
+    # Mostly small counts with the occasional flock
+    count = rng.geometric(0.35, rows)
+    flock = rng.random(rows) < 0.02
+    count[flock] = rng.integers(20, 500, flock.sum())
+
+    breeding = rng.choice(len(breedingStatuses), rows, p=breedingWeights)
+
+    return pd.DataFrame({'BOU order'               : bouOrder[speciesIndex],
+                         'Species'                 : speciesNames,
+                         'Place'                   : np.char.add('Place ', place.astype(str)),
+                         '1km Grid Ref'            : gridRef,
+                         'Observer name'           : np.char.add('Observer ', observer.astype(str)),
+                         'Date'                    : dates.strftime('%d/%m/%Y'),
+                         'Count'                   : count,
+                         'Numerical count'         : count,
+                         'Decoded Breeding Status' : np.array(breedingStatuses, dtype=object)[breeding]})
+
+def generateFile(rows, seed, years, folder):
+    # Write the synthetic records to csv a block at a time so that generating the largest
+    # files does not need them all in memory.  Files are reused between runs
+    filePath = folder / 'synthetic_{}_seed{}_years{}.csv'.format(rows, seed, years)
+    if filePath.exists():
+        return filePath
+    print('Generating {} records in {}'.format(rows, filePath))
+    rng = np.random.default_rng(seed)
+    partPath = filePath.with_suffix('.part')
+    written = 0
+    while written < rows:
+        block = generateRecords(min(blockSize, rows - written), rng, years)
+        block.to_csv(partPath, mode='a' if written else 'w', header=(written == 0), index=False)
+        written += len(block)
+    partPath.rename(filePath)
+    return filePath
+
+def runSpeciesSummary(inputFilePath, folder, chunksize, traceMemory, outputFormat):
+    # Run speciesSummary.py in its own process so each run's peak memory is its own
+    timingsFilePath = folder / 'timings.json'
+    outputFilePath = folder / ('speciesSummary.xlsx' if outputFormat.startswith('excel') else 'speciesSummary_' + outputFormat)
+    command = [sys.executable, str(pathlib.Path(__file__).parent / 'speciesSummary.py'),
+               '-i', str(inputFilePath), '-t', '3000', '-f', str(outputFilePath),
+               '--output_format', outputFormat, '--timings_file_path', str(timingsFilePath)]
+    if chunksize:
+        command += ['--chunksize', str(chunksize)]
+    if traceMemory:
+        command.append('--trace_memory')
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    wallSeconds = time.perf_counter() - start
+    with open(timingsFilePath) as file:
+        timings = json.load(file)
+    timings['wall_seconds'] = wallSeconds
+    return timings
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except OSError:
+        return ''
+
+def compareReports(report, baseline):
+    # Print the ratio of this run's stage times to the baseline's for each matching size and
+    # output format (reports from before output formats were benchmarked are all excel)
+    baselineRuns = {(run['rows'], run.get('output_format', 'excel')): run for run in baseline['runs']}
+    print('Comparison with {} (ratio < 1 is faster)'.format(baseline.get('git_commit') or 'baseline'))
+    for run in report['runs']:
+        if (run['rows'], run['output_format']) not in baselineRuns:
+            continue
+        baselineRun = baselineRuns[(run['rows'], run['output_format'])]
+        print('{} records {}: total {:.2f}x, peak RSS {:.2f}x'.format(run['rows'], run['output_format'],
+              run['wall_seconds'] / baselineRun['wall_seconds'],
+              run['peak_rss_mb'] / baselineRun['peak_rss_mb']))
+        for name, stage in run['stages'].items():
+            if name in baselineRun['stages'] and baselineRun['stages'][name]['seconds'] > 0:
+                print('    {:<12} {:.2f}x'.format(name, stage['seconds'] / baselineRun['stages'][name]['seconds']))
+
+parser = argparse.ArgumentParser(description='Benchmark speciesSummary.py against synthetic BirdTrack data',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('-n', '--sizes', type=int, nargs='+', required=False, default=[10000, 100000, 1000000, 10000000], help='numbers of records to benchmark')
+parser.add_argument('-s', '--seed', type=int, required=False, default=42, help='seed for the synthetic data generator')
+parser.add_argument('-y', '--years', type=int, required=False, default=1, help='number of years the synthetic records span')
+parser.add_argument('-w', '--work_folder', type=str, required=False, default='benchmark', help='folder for the generated input files and summary output')
+parser.add_argument('-k', '--chunksize', type=int, required=False, default=None, help='chunksize to pass to speciesSummary.py')
+parser.add_argument('-q', '--output_formats', type=str, nargs='+', required=False, default=['excel'], choices=outputFormats, help='output formats of speciesSummary.py to benchmark')
+parser.add_argument('-m', '--trace_memory', action='store_true', help='record the peak memory allocated within each stage (slower)')
+parser.add_argument('-r', '--report_file_path', type=str, required=False, default='speciesSummaryBenchmark.json', help='filepath for the JSON report')
+parser.add_argument('-b', '--baseline_report_path', type=str, required=False, default=None, help='JSON report from an earlier version to compare against')
+
+args = parser.parse_args()
+config = vars(args)
+
+folder = pathlib.Path(args.work_folder)
+folder.mkdir(parents=True, exist_ok=True)
+
+report = {'git_commit' : gitCommit(),
+          'created'    : time.strftime('%Y-%m-%dT%H:%M:%S'),
+          'python'     : platform.python_version(),
+          'pandas'     : pd.__version__,
+          'numpy'      : np.__version__,
+          'machine'    : platform.platform(),
+          'config'     : config,
+          'runs'       : []}
+
+for rows in args.sizes:
+    inputFilePath = generateFile(rows, args.seed, args.years, folder)
+    for outputFormat in args.output_formats:
+        print('Benchmarking {} records with {} output'.format(rows, outputFormat))
+        timings = runSpeciesSummary(inputFilePath, folder, args.chunksize, args.trace_memory, outputFormat)
+        timings['rows'] = rows
+        report['runs'].append(timings)
+        print('{} records took {:.1f}s with a peak RSS of {}MB'.format(rows, timings['wall_seconds'], timings['peak_rss_mb']))
+        for name, stage in timings['stages'].items():
+            print('    {:<12} {:8.2f}s'.format(name, stage['seconds']))
+
+        # write the report after every run so a long benchmark still leaves results behind
+        with open(args.report_file_path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+print('Report written to {}'.format(args.report_file_path))
+
+if args.baseline_report_path:
+    with open(args.baseline_report_path) as file:
+        compareReports(report, json.load(file))
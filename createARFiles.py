@@ -4,13 +4,21 @@
 # 2.  Observation tables for the following seasons: Winter/Spring, Summer, Autumn/Winter.
 #     See the script reformatBirdtrack.py for definitions of these seasons.
 #     Each table is sorted
+#
+# The documents made are recorded in a manifest (output/manifest.json by default) so a re-run only rebuilds
+# the species whose records, reference data or template have changed, and deletes the documents of species
+# that are no longer in the input.  --force rebuilds every species.
+#
+# With --combined_file_path one annual report document holding every species in BOU order is made instead.
+# Each species section is built in a worker process as XML and the sections are added to the report in order.
+#
+# The tables can be restricted to the most significant counts for each species and season with --selection_rule:
+#       quantile - counts at or above the given quantile, eg. 0.9 keeps the top 10% of counts
+#       ratio    - counts at or above the given fraction of the maximum count, eg. 0.75
+# with per species rules in a csv of species, rule, value rows (--selection_file_path).  Counts such as Present
+# that have no number are always kept.
 #     
-# TODO: Restrict the counts included in the tables based on a minimum count value.  This could either be based on some
-#       configuration value for each species or perhaps a numerical analysis of the counts
-#       eg. the top 10% of counts or counts > 75% of the maximum count for that species.
-#       This would allow the report to be more concise and focused on the most significant observations.
-
-#       It could also include a generated paragraph based on some boiler plate text covering things like:
+# TODO: Include a generated paragraph based on some boiler plate text covering things like:
 #       -  The status of the species in clyde - 
 #                   Resident/Non Resident, Breeder/Non Breeder, Summer/Winter Visitor, Passage Migrant, Vagrant etc.
 #       -  For winter/summer visitors the earliest and latest dates recorded
@@ -22,82 +30,136 @@ from docx.shared import RGBColor
 from docx.shared import Pt
 from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.dml import MSO_THEME_COLOR
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from lxml import etree
 
 import argparse
+import copy
+import hashlib
+import io
+import json
+import os
 import pandas as pd
 import numpy as np
 import re
+import sys
 import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from speciesTaxonomy import SpeciesTaxonomy
 
-def createDocument():
-    document = Document()
+# Bump whenever a change to this script alters the documents it produces, so that an
+# incremental run rebuilds every species rather than keeping documents made the old way
+generatorVersion = '1'
 
-    obj_styles = document.styles
+# Character styles used in the species header, added to the template unless it already has them
+speciesStyles = {'SpeciesStyle'    : {'size' : 18, 'bold'   : True},
+                 'ScientificStyle' : {'size' : 14, 'italic' : True},
+                 'BouStyle'        : {'size' : 12, 'bold'   : True},
+                 'BtoStyle'        : {'size' : 12, 'bold'   : True}}
 
-    obj_charstyle = obj_styles.add_style('SpeciesStyle', WD_STYLE_TYPE.CHARACTER)
-    obj_font = obj_charstyle.font
-    obj_font.size = Pt(18)
-    obj_font.name = 'Ariel'
-    obj_font.bold = True
-
-    obj_charstyle = obj_styles.add_style('ScientificStyle', WD_STYLE_TYPE.CHARACTER)
-    obj_font = obj_charstyle.font
-    obj_font.size = Pt(14)
-    obj_font.name = 'Ariel'
-    obj_font.italic = True
-
-    obj_charstyle = obj_styles.add_style('BouStyle', WD_STYLE_TYPE.CHARACTER)
-    obj_font = obj_charstyle.font
-    obj_font.size = Pt(12)
-    obj_font.name = 'Ariel'
-    obj_font.bold = True
-
-    obj_charstyle = obj_styles.add_style('BtoStyle', WD_STYLE_TYPE.CHARACTER)
-    obj_font = obj_charstyle.font
-    obj_font.size = Pt(12)
-    obj_font.name = 'Ariel'
-    obj_font.bold = True
+def readTemplate(templateFilePath):
+    # Open a user's .docx or .dotx keeping its styles, page setup and headers but none of
+    # its body text.  python-docx only opens documents, so a .dotx is relabelled as one
+    with open(templateFilePath, 'rb') as file:
+        package = file.read()
+    if templateFilePath.lower().endswith('.dotx'):
+        source = zipfile.ZipFile(io.BytesIO(package))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as target:
+            for item in source.infolist():
+                data = source.read(item.filename)
+                if item.filename == '[Content_Types].xml':
+                    data = data.replace(b'wordprocessingml.template.main+xml', b'wordprocessingml.document.main+xml')
+                target.writestr(item, data)
+        package = buffer.getvalue()
+    document = Document(io.BytesIO(package))
+    body = document.element.body
+    for element in list(body):
+        if not element.tag.endswith('}sectPr'):
+            body.remove(element)
     return document
 
-def createSpeciesHeader(species_df):
-    scientificName = species_df['Scientific name'].unique()
-    row = reference_df.query("Scientific_name == @scientificName[0]")
-    if  len(row) > 0:
-        bou_cat = row.iloc[0]['BOU_category']
-        bto_code = row.iloc[0]['BTO_Code']
-        cons_stat = row.iloc[0]['Scotland']
+def createTemplate(templateFilePath=None):
+    # Build the styled starting document once and keep it as an in memory package that
+    # createDocument opens for each species
+    document = readTemplate(templateFilePath) if templateFilePath else Document()
+
+    obj_styles = document.styles
+    existingStyles = {style.name for style in obj_styles}
+    for name, font in speciesStyles.items():
+        if name in existingStyles:
+            continue
+        obj_charstyle = obj_styles.add_style(name, WD_STYLE_TYPE.CHARACTER)
+        obj_font = obj_charstyle.font
+        obj_font.size = Pt(font['size'])
+        obj_font.name = 'Ariel'
+        if font.get('bold'):
+            obj_font.bold = True
+        if font.get('italic'):
+            obj_font.italic = True
+
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def createDocument(template):
+    return Document(io.BytesIO(template))
+
+# Colours of the Scottish conservation status lists, checked in this order
+conservationColours = {'Green' : RGBColor(0, 176, 80),
+                       'Amber' : RGBColor(255, 192, 0),
+                       'Red'   : RGBColor(255, 0, 0)}
+
+def formatBouCategory(bou_cat):
+    # AC1E becomes A, C1, E - each of the categories B to E starts a new entry and F is dropped
+    if pd.isna(bou_cat):
+        return 'na'
+    reformatted_bou = ''
+    first_letter = True
+    for letter in bou_cat:
+        if first_letter:
+            reformatted_bou = letter
+            first_letter = False
+        else:
+            if re.match(r'[BCDE]', letter):
+                reformatted_bou += ', '
+            if letter != 'F':
+                reformatted_bou += letter
+    return reformatted_bou
+
+def loadReference(dataFilePath):
+    # Read the reference data once into a dictionary keyed by scientific name holding the fields
+    # shown in the species header - the formatted BOU category, the BTO code ('na' unless it is
+    # a valid two character code) and the conservation status list (None if it isn't one of
+    # conservationColours).  Only the first row for each scientific name is used
+    reference_df = pd.read_csv(dataFilePath, dtype=str).drop_duplicates('Scientific_name')
+    reference = {}
+    for scientificName, bou_cat, bto_code, cons_stat in zip(reference_df['Scientific_name'], reference_df['BOU_category'],
+                                                             reference_df['BTO_Code'], reference_df['Scotland']):
+        btoValid = pd.notna(bto_code) and re.match(r"^[A-Z][A-Z\.]$", bto_code)
+        status = [colour for colour in conservationColours if pd.notna(cons_stat) and colour in cons_stat]
+        reference[scientificName] = {'bou'    : formatBouCategory(bou_cat),
+                                     'bto'    : bto_code if btoValid else 'na',
+                                     'status' : status[0] if status else None}
+    return reference
+
+def createSpeciesHeader(document, species, species_df, reference):
+    scientificName = species_df['Scientific name'].iloc[0]
+    fields = reference.get(scientificName)
+    if fields is not None:
         p = document.add_paragraph('')
-        wp = p.add_run(species, style='SpeciesStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
+        p.add_run(species, style='SpeciesStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
         p.add_run(' ')
         p.add_run(scientificName, style='ScientificStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
         p.add_run('\t\t')
-        if pd.notna(bou_cat):
-            reformatted_bou = ''
-            first_letter = True
-            for letter in bou_cat:
-                if first_letter:
-                    reformatted_bou = letter
-                    first_letter = False
-                else:
-                    if re.match(r'[BCDE]', letter):
-                        reformatted_bou += ', '
-                    if letter != 'F':
-                        reformatted_bou += letter
-            p.add_run(reformatted_bou, style='BouStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
-        else:
-            p.add_run('na', style='BouStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
+        p.add_run(fields['bou'], style='BouStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
         p.add_run(' / ', style='BtoStyle')
-        if re.match(r"^[A-Z][A-Z\.]$", bto_code):
-            p.add_run(bto_code, style='BtoStyle')
-        else:
-            p.add_run('na', style='BtoStyle')
+        p.add_run(fields['bto'], style='BtoStyle')
         p.add_run(' / ', style='BtoStyle')
-        if 'Green' in cons_stat:
-            p.add_run('Green', style='BtoStyle').font.color.rgb = RGBColor(0, 176, 80)
-        elif 'Amber' in cons_stat:
-            p.add_run('Amber', style='BtoStyle').font.color.rgb = RGBColor(255, 192, 0)
-        elif 'Red' in cons_stat:
-            p.add_run('Red', style='BtoStyle').font.color.rgb = RGBColor(255, 0, 0)
+        if fields['status'] is not None:
+            p.add_run(fields['status'], style='BtoStyle').font.color.rgb = conservationColours[fields['status']]
         else:
             p.add_run('na', style='BtoStyle').font.color.theme_color = MSO_THEME_COLOR.ACCENT_1
 
@@ -112,15 +174,44 @@ def process_season(season, document, season_df):
         hdr_cells[1].text = 'Place'
         hdr_cells[2].text = 'Date'
         hdr_cells[3].text = 'Comment'
-        for index, row in season_df.iterrows():
-            row_cells = table.add_row().cells
-            row_cells[0].text = str(row['Count'])
-            row_cells[1].text = row['Place']
-            row_cells[2].text = row['Date'].strftime('%d %b')
-            if row['Comment'] != 0:
-                row_cells[3].text = row['Comment']
-
-def createObsTable(species_df):
+        comments = season_df['Comment']
+        appendTableRows(table, zip(season_df['Count'].astype(str),
+                                   season_df['Place'],
+                                   season_df['Date'].dt.strftime('%d %b'),
+                                   comments.where(comments != 0, None)))
+
+def appendTableRows(table, rows):
+    # Add a row to the table for each tuple of cell texts (None leaves a cell empty).  The
+    # rows are copied from one empty row made by python-docx and filled in with lxml, which
+    # gives the same XML as setting each cell's text but without python-docx's per row work
+    prototype = table.add_row()._tr
+    tbl = prototype.getparent()
+    tbl.remove(prototype)
+    newRows = []
+    for texts in rows:
+        tr = copy.deepcopy(prototype)
+        for tc, text in zip(tr.iterchildren(qn('w:tc')), texts):
+            if text is not None:
+                appendRun(tc.find(qn('w:p')), str(text))
+        newRows.append(tr)
+    tbl.extend(newRows)
+
+def appendRun(p, text):
+    # The run python-docx writes for text - runs of characters in w:t elements (preserving
+    # space at either end) separated by w:tab for tabs and w:br for line breaks
+    r = etree.SubElement(p, qn('w:r'))
+    for part in re.split(r'([\t\r\n])', text):
+        if part == '\t':
+            etree.SubElement(r, qn('w:tab'))
+        elif part in ('\r', '\n'):
+            etree.SubElement(r, qn('w:br'))
+        elif part:
+            t = etree.SubElement(r, qn('w:t'))
+            t.text = part
+            if len(part.strip()) < len(part):
+                t.set(qn('xml:space'), 'preserve')
+
+def createObsTable(document, species_df):
     season_df = species_df[species_df['Season'] == 'Winter/Spring']
     process_season('Winter/Spring', document, season_df)
 
@@ -130,44 +221,278 @@ def createObsTable(species_df):
     season_df = species_df[species_df['Season'] == 'Autumn/Winter']
     process_season('Autumn/Winter', document, season_df)
 
-start_time = time.time()
+def speciesFileName(species, species_df):
+    bouOrder = species_df['BOU order'].unique()
+    reformatedSpecies = species.replace(' ', '_')
+    reformatedSpecies = reformatedSpecies.replace('/','')
+    reformatedSpecies = str(bouOrder[0]) + '-' + reformatedSpecies
+    return 'output/' + '{}.docx'.format(reformatedSpecies)
+
+def createSpeciesDocument(species, species_df, reference, template):
+    # Build and save the document for one species.  Returns the species, its file name, the
+    # error that stopped the document being created (None if it was created) and the time
+    # taken to set up the document from the template
+    fileName = speciesFileName(species, species_df)
+    setupSeconds = 0.0
+    try:
+        setupStart = time.perf_counter()
+        document = createDocument(template)
+        setupSeconds = time.perf_counter() - setupStart
+        createSpeciesHeader(document, species, species_df, reference)
+        createObsTable(document, species_df)
+        document.save(fileName)
+    except Exception as error:
+        return species, fileName, '{}: {}'.format(type(error).__name__, error), setupSeconds
+    return species, fileName, None, setupSeconds
+
+def createSpeciesSection(species, species_df, reference, template):
+    # Build one species' section of the combined report.  Returns the species, the section as
+    # XML (the body of its document without the section properties), the error that stopped
+    # the section being created (None if it was created) and the time taken to set up the
+    # document from the template
+    setupSeconds = 0.0
+    try:
+        setupStart = time.perf_counter()
+        document = createDocument(template)
+        setupSeconds = time.perf_counter() - setupStart
+        createSpeciesHeader(document, species, species_df, reference)
+        createObsTable(document, species_df)
+        section = b''.join(etree.tostring(element) for element in document.element.body
+                           if element.tag != qn('w:sectPr'))
+    except Exception as error:
+        return species, None, '{}: {}'.format(type(error).__name__, error), setupSeconds
+    return species, section, None, setupSeconds
+
+def createCombinedReport(template, sections, fileName):
+    # Add the species sections, in the order given, to one document made from the template.
+    # All the sections come from the same template so their styles are already in it
+    document = createDocument(template)
+    body = document.element.body
+    sectPr = body.find(qn('w:sectPr'))
+    for section in sections:
+        for element in parse_xml(b'<w:body %s>' % nsdecls('w').encode() + section + b'</w:body>'):
+            if sectPr is not None:
+                sectPr.addprevious(element)
+            else:
+                body.append(element)
+    document.save(fileName)
+
+# Rules for choosing the significant records of a species and season, with the value used
+# when none is given
+selectionRules = {'all' : None, 'quantile' : 0.9, 'ratio' : 0.75}
+
+def loadSelectionRules(rule, value, filePath=None):
+    # The default rule as a (rule, value) pair and a dictionary of the per species rules
+    # read from a csv of species, rule, value rows (a blank value uses the rule's default)
+    default = (rule, selectionRules[rule] if value is None else value)
+    overrides = {}
+    if filePath is not None:
+        rules_df = pd.read_csv(filePath, dtype=str, keep_default_na=False)
+        unknownRules = set(rules_df['rule']) - set(selectionRules)
+        if unknownRules:
+            sys.exit('ERROR - unknown selection rules {} in {}, expected {}'.format(sorted(unknownRules), filePath, list(selectionRules)))
+        for species, rule, value in rules_df[['species', 'rule', 'value']].itertuples(index=False):
+            overrides[species] = (rule, float(value) if value else selectionRules[rule])
+    return default, overrides
+
+def numericCounts(counts):
+    # The number in each count (100+ and c40 become 100 and 40), NaN for counts such as Present
+    return pd.to_numeric(counts.astype(str).str.extract(r'(\d+)', expand=False), errors='coerce')
+
+def selectSignificantRecords(df, default, overrides):
+    # Drop the records whose counts aren't significant for their species and season under the
+    # rule for the species.  Returns the remaining records and the number of records each rule
+    # dropped
+    counts = numericCounts(df['Count'])
+    speciesRules = {species: overrides.get(species, default) for species in df['Species'].unique()}
+    rules = df['Species'].map({species: rule for species, (rule, value) in speciesRules.items()})
+    values = df['Species'].map({species: value for species, (rule, value) in speciesRules.items()})
+    drop = np.zeros(len(df), dtype=bool)
+    dropped = {}
+    for (rule, value), ruleIndex in df.groupby([rules, values], sort=False, dropna=False).groups.items():
+        if rule == 'all':
+            continue
+        inRule = df.index.isin(ruleIndex)
+        groups = counts[inRule].groupby([df.loc[inRule, 'Species'], df.loc[inRule, 'Season']])
+        if rule == 'quantile':
+            threshold = groups.transform('quantile', value)
+        else:
+            threshold = groups.transform('max') * value
+        # a missing count or threshold compares as False so the record is kept
+        drop[inRule] = (counts[inRule] < threshold).to_numpy()
+        dropped['{} {}'.format(rule, value)] = int(drop[inRule].sum())
+    return df[~drop], dropped
+
+def templateDigest(template):
+    # Hash the parts of the template package rather than the package itself, which holds the
+    # time it was saved
+    digest = hashlib.sha256(generatorVersion.encode())
+    with zipfile.ZipFile(io.BytesIO(template)) as package:
+        for name in sorted(package.namelist()):
+            digest.update(name.encode())
+            digest.update(package.read(name))
+    return digest.hexdigest()
+
+def speciesHashes(df, speciesSlices, reference, template):
+    # One hash per species covering its input rows, its reference data, the generator
+    # version and the template - a document only needs rebuilding when its hash changes
+    rowHashes = pd.util.hash_pandas_object(df, index=False)
+    base = templateDigest(template)
+    hashes = {}
+    for species, species_df in speciesSlices:
+        digest = hashlib.sha256(base.encode())
+        digest.update(rowHashes.loc[species_df.index].to_numpy().tobytes())
+        digest.update(repr(reference.get(species_df['Scientific name'].iloc[0])).encode())
+        hashes[species] = digest.hexdigest()
+    return hashes
+
+def loadManifest(manifestFilePath):
+    # The species documents made by the last run - species name to file name and hash
+    try:
+        with open(manifestFilePath) as file:
+            return json.load(file)['species']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def saveManifest(manifestFilePath, entries):
+    with open(manifestFilePath, 'w') as file:
+        json.dump({'generator' : generatorVersion, 'species' : entries}, file, indent=1)
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Create Bird Report species headings from a reformated Birdtrack export",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-f", "--file_path", type=str, required=True, help='Filepath to the Excel file to be processed')
+    parser.add_argument("-s", "--sheet_name", type=str, required=True, help='name of the sheet to be updated')
+    parser.add_argument("-d", "--data_file_path", type=str, required=True, help='Filepath to the csv file containing reference data')
+    parser.add_argument("-t", "--template_file_path", type=str, required=False, default=None, help='Filepath to a .dotx or .docx whose styles and page setup are used for every species document')
+    parser.add_argument("-w", "--workers", type=int, required=False, default=os.cpu_count(), help='Number of processes creating species documents in parallel')
+    parser.add_argument("-m", "--manifest_file_path", type=str, required=False, default='output/manifest.json', help='Filepath to the manifest of the documents made by the last run, only species whose records, reference data or template have changed are rebuilt')
+    parser.add_argument("-r", "--selection_rule", type=str, required=False, default='all', choices=list(selectionRules), help='Rule choosing the significant records of each species and season to include in the tables')
+    parser.add_argument("-v", "--selection_value", type=float, required=False, default=None, help='Quantile or fraction of the maximum count used by the selection rule (defaults to 0.9 for quantile and 0.75 for ratio)')
+    parser.add_argument("-o", "--selection_file_path", type=str, required=False, help='Filepath to a csv of species, rule, value rows giving the selection rule for particular species')
+    parser.add_argument("-c", "--combined_file_path", type=str, required=False, help='Filepath to a single annual report document holding every species in BOU order, created instead of the separate species documents')
+    parser.add_argument("--force", action='store_true', help='Rebuild every species document whether or not it has changed')
+
+    args = parser.parse_args()
+    config = vars(args)
+
+    df = pd.read_excel(args.file_path, converters= {'Date': pd.to_datetime}, sheet_name=args.sheet_name).fillna(value = 0)
+    print('Input file contains {} records'.format(len(df)))
+
+    # sort the input file by BOU order, Species and Date
+    df.sort_values(by=['BOU order', 'Species', 'Date'], inplace=True)
+    print('Input file sorted')
+
+    reference = loadReference(args.data_file_path)
+
+    # drop the Unidentified species and split the records by species in one pass, keeping
+    # the species in report order
+    taxonomy = SpeciesTaxonomy()
+    df = df[~taxonomy.isUnidentified(df['Species'])]
 
-parser = argparse.ArgumentParser(description="Create Bird Report species headings from a reformated Birdtrack export",
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # keep only the significant records of each species and season
+    default, overrides = loadSelectionRules(args.selection_rule, args.selection_value, args.selection_file_path)
+    df, dropped = selectSignificantRecords(df, default, overrides)
+    for rule, count in dropped.items():
+        print('Selection rule {} dropped {} records'.format(rule, count))
+    speciesSlices = list(df.groupby('Species', sort=False))
 
-parser.add_argument("-f", "--file_path", type=str, required=True, help='Filepath to the Excel file to be processed')
-parser.add_argument("-s", "--sheet_name", type=str, required=True, help='name of the sheet to be updated')
-parser.add_argument("-d", "--data_file_path", type=str, required=True, help='Filepath to the csv file containing reference data')
+    # Species without reference data get a document with no header
+    unmatched = [species for species, species_df in speciesSlices
+                 if species_df['Scientific name'].iloc[0] not in reference]
+    if unmatched:
+        print('No reference data for {} species, their documents will have no header:'.format(len(unmatched)))
+        for species in unmatched:
+            print('    {}'.format(species))
 
-args = parser.parse_args()
-config = vars(args)
+    templateStart = time.perf_counter()
+    template = createTemplate(args.template_file_path)
+    templateSeconds = time.perf_counter() - templateStart
 
-df = pd.read_excel(args.file_path, converters= {'Date': pd.to_datetime}, sheet_name=args.sheet_name).fillna(value = 0)
-print('Input file contains {} records'.format(len(df)))
+    fileNames = {species: speciesFileName(species, species_df) for species, species_df in speciesSlices}
+    order = {species: position for position, (species, _) in enumerate(speciesSlices)}
+    if args.combined_file_path:
+        # every species goes into the combined report, the manifest only covers the separate
+        # documents
+        createSpecies, workSlices = createSpeciesSection, speciesSlices
+    else:
+        # Work out which species have changed since the last run.  Species are rebuilt if their
+        # hash differs from the manifest or their document has gone, or always with --force
+        manifest = loadManifest(args.manifest_file_path)
+        hashes = speciesHashes(df, speciesSlices, reference, template)
+        entries = {}
+        changedSlices = []
+        for species, species_df in speciesSlices:
+            previous = manifest.get(species, {})
+            if (not args.force and previous.get('hash') == hashes[species] and
+                    previous.get('file') == fileNames[species] and os.path.exists(fileNames[species])):
+                entries[species] = previous
+            else:
+                changedSlices.append((species, species_df))
+        createSpecies, workSlices = createSpeciesDocument, changedSlices
 
-# sort the input file by BOU order, Species and Date
-df.sort_values(by=['BOU order', 'Species', 'Date'], inplace=True)
-print('Input file sorted')
+    # Create the documents (or sections) across a pool of processes, reporting each species as
+    # it finishes
+    failures = []
+    setupSeconds = 0.0
+    if args.workers > 1 and len(workSlices) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(createSpecies, species, species_df, reference, template)
+                       for species, species_df in workSlices]
+            results = [future.result() for future in as_completed(futures)]
+            for species, output, error, seconds in results:
+                print('Processed {}'.format(species), end='\x1b[1K\r')
+                setupSeconds += seconds
+                if error is not None:
+                    failures.append((species, error))
+    else:
+        results = []
+        for species, species_df in workSlices:
+            print('Processing {}'.format(species), end='\x1b[1K\r')
+            results.append(createSpecies(species, species_df, reference, template))
+            setupSeconds += results[-1][3]
+            if results[-1][2] is not None:
+                failures.append((species, results[-1][2]))
 
-reference_df = pd.read_csv(args.data_file_path)
+    print('')
+    if args.combined_file_path:
+        # stitch the sections together in report order, leaving out the species that failed
+        sections = {species: section for species, section, error, seconds in results if error is None}
+        assembleStart = time.perf_counter()
+        createCombinedReport(template, [sections[species] for species, _ in speciesSlices if species in sections],
+                             args.combined_file_path)
+        print('Added {} of {} species to {}, assembled in {:.3f}s'.format(
+              len(sections), len(speciesSlices), args.combined_file_path, time.perf_counter() - assembleStart))
+    else:
+        # Failed species are left out of the manifest so the next run tries them again
+        for species, fileName, error, seconds in results:
+            if error is None:
+                entries[species] = {'file' : fileName, 'hash' : hashes[species]}
+        entries = dict(sorted(entries.items(), key=lambda entry: order[entry[0]]))
 
-#get the list of species in the report
-speciesList = df.Species.unique()
+        # Delete the documents of species no longer in the input (or whose file name has changed)
+        currentFiles = set(fileNames.values())
+        removed = 0
+        for species, previous in manifest.items():
+            fileName = previous.get('file')
+            if fileName and fileName not in currentFiles and os.path.exists(fileName):
+                os.remove(fileName)
+                removed += 1
+        saveManifest(args.manifest_file_path, entries)
 
-for species in speciesList:
-    if not species.startswith('Unidentified'):
-        print('Processing {}'.format(species), end='\x1b[1K\r')
-        species_df = df[df['Species'] == species]
-        document = createDocument()
-        createSpeciesHeader(species_df)
-        createObsTable(species_df)
-        bouOrder = species_df['BOU order'].unique()
-        reformatedSpecies = species.replace(' ', '_')
-        reformatedSpecies = reformatedSpecies.replace('/','')
-        reformatedSpecies = str(bouOrder[0]) + '-' + reformatedSpecies
-        document.save('output/' + '{}.docx'.format(reformatedSpecies))
+        print('Created {} of {} changed species documents, {} unchanged, {} removed'.format(
+              len(changedSlices) - len(failures), len(changedSlices), len(speciesSlices) - len(changedSlices), removed))
+    print('Template built in {:.3f}s, document setup took {:.3f}s ({:.1f}ms per species)'.format(
+          templateSeconds, setupSeconds, 1000 * setupSeconds / max(len(workSlices), 1)))
+    if failures:
+        # report in the order the species appear in the report
+        print('Failed to create documents for {} species:'.format(len(failures)))
+        for species, error in sorted(failures, key=lambda failure: order[failure[0]]):
+            print('    {} ({}) - {}'.format(species, fileNames[species], error))
 
-runTime = time.time() - start_time
-convert = time.strftime("%H:%M:%S", time.gmtime(runTime))
-print('')
-print('Execution took {}'.format(convert))
\ No newline at end of file
+    runTime = time.time() - start_time
+    convert = time.strftime("%H:%M:%S", time.gmtime(runTime))
+    print('Execution took {}'.format(convert))
@@ -6,58 +6,67 @@
 # the BirdTrack Excel Spreadsheet.
 # It overwrites the BirdTrack Excel spreadsheet but saves a backup of the original with a suffix .bak
 # NB it does not tolerate file paths containing spaces
+# Very large extracts can be streamed with --chunksize.  Each chunk is filtered to species
+# records, converted to BirdTrack records and saved to a temporary store, and the workbook
+# is then written once at the end a row at a time (other sheets in the workbook are kept as
+# values only).
+# With --duplicates the eBird records that look like observations already submitted to
+# BirdTrack (see sourceDuplicates.py) are flagged in their comment or left out.
 
 import argparse
+import numpy as np
 import pandas as pd
 import datetime
 from datetime import date, datetime
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+import os
+import pathlib
 import shutil
+import sys
+import tempfile
 import time
+from speciesTaxonomy import SpeciesTaxonomy
+from sourceDuplicates import DuplicateIndex
 start_time = time.time()
 
-parser = argparse.ArgumentParser(description="Merge eBird extract into BirdTrack export",
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-parser.add_argument("-e", "--ebird_file_path", type=str, required=True, 
-                    help='Filepath to the eBird export csv file to be merged from')
-
-parser.add_argument("-b", "--birdtrack_file_path", type=str, required=True, 
-                    help='Filepath to the BirdTrack export Excel file to be merged into')
-
-parser.add_argument("-o", "--birdtrack_bou_order_file_path", type=str, required=True, 
-                    help='Filepath to the BirdTrack BOU order csv file')
-
-args = parser.parse_args()
-config = vars(args)
-
-# Save a backup of the original file
-backup = args.birdtrack_file_path.replace('.xlsx', '.bak')
-shutil.copyfile(args.birdtrack_file_path, backup)
-print('Backup copy of input BirdTrack data saved as {}'.format(backup))
-
-# Open the files
-eBird_df = pd.read_csv(args.ebird_file_path, converters= {'Date': pd.to_datetime,})
-print('eBird file contains {} records'.format(len(eBird_df)))
-
-#Drop all rows where eBird category is not species'
-filtered_df = eBird_df.query("eBird_category == 'species' | eBird_category.isnull()", engine='python')
-print('eBird file contains {} species records'.format(len(filtered_df)))
-
-bouOrder_df = pd.read_csv(args.birdtrack_bou_order_file_path)
-print('Birdtrack BOU Sequence file read')
-
-sheetname = 'Records#1'
-birdTrack_df = pd.read_excel(args.birdtrack_file_path, sheet_name=sheetname, converters= {'Date': pd.to_datetime, 'dayfirst': True})
-print('Birdtrack export file to be merged into already contains {} records'.format(len(birdTrack_df)))
-
-btoSpeciesCode = ''
-uncertaintyRadius = ''
-geometryType = ''
-pinpoint = ''
-userId = 'eBird'
-userName = 'eBird'
-endTime = ''
-plumage = ''
+# The BirdTrack columns filled straight from eBird columns
+eBirdColumns = {'Species'         : 'species',
+                'Scientific name' : 'scientific_name',
+                'Place'           : 'locality',
+                'Grid reference'  : 'os1km',
+                'Lat'             : 'latitude',
+                'Long'            : 'longitude',
+                'Observer name'   : 'full_name'}
+# The BirdTrack columns with the same value for every eBird record
+constantColumns = {'BTO species code'   : '',
+                   'Uncertainty radius' : '',
+                   'Geometry type'      : '',
+                   'Pinpoint'           : '',
+                   'User ID'            : 'eBird',
+                   'User name'          : 'eBird',
+                   'End time'           : '',
+                   'Plumage'            : '',
+                   'Breeding details'   : '',
+                   'Remarkable'         : '',
+                   'Habitat notes'      : '',
+                   'Flight'             : '',
+                   'Activity'           : '',
+                   'Source'             : 'eBird',
+                   'Created date'       : '',
+                   'Obs ID'             : '',
+                   'Complete list'      : 'N',
+                   'Geometry'           : ''}
+# The layout of the BirdTrack export sheet
+birdTrackColumns = ['BTO species code', 'BOU order', 'Species', 'Scientific name', 'Place', 'Grid reference',
+                    'Uncertainty radius', 'Geometry type', 'Lat', 'Long', 'Pinpoint', 'Observer name', 'User ID',
+                    'User name', 'Date', 'Start time', 'End time', 'Count', 'Comment', 'Plumage', 'Breeding status',
+                    'Breeding details', 'Sensitive', 'Remarkable', 'Habitat notes', 'Flight', 'Activity', 'Source',
+                    'Created date', 'Obs ID', 'Complete list', 'Geometry']
+# The BirdTrack columns used to find records submitted to both BirdTrack and eBird
+duplicateColumns = ['Scientific name', 'Date', 'Grid reference', 'Observer name', 'Count', 'Start time']
+duplicateComment = 'Possible duplicate of a BirdTrack record'
 breedingCodeDict = {'NY' : '13',
                     'NE' : '15',
                     'FS' : '14',
@@ -81,91 +90,254 @@ breedingCodeDict = {'NY' : '13',
                     'S' : '02',
                     'H' : '03',
                     'F' : '00'}
-eBirdCodes = ['NY', 'NE', 'FS', 'FY', 'CF', 'FL', 'ON', 'UN', 'DD',
-             'NB', 'CN', 'PE', 'B', 'A', 'N', 'C', 'T', 'P', 'M', 'S7', 'S', 'H', 'F']
-breedingDetails = ''
-remarkable = ''
-habitatNotes = ''
-flight = ''
-activity = ''
-source = 'eBird'
-createdDate = ''
-obsID = ''
-completeList = 'N'
-geometry = ''
-
-# Loop through the eBird dataframe extracting required data and add rows to the BirdTrack dataframe
-for index, row in filtered_df.iterrows():
-    print('Processing ebird row {}'.format(index + 1), end='\r')
-    scientificName = row['scientific_name']
-
-    # Lookup BOU Order
-    bou_row = bouOrder_df.query("LATIN_NAME == @scientificName")
-    if  len(bou_row) > 0:
-        bouOrder = bou_row.iloc[0]['BOU_ORDER']
-    else:
-        print('Cannot find BOU Order for scientific name {}'.format(scientificName))
+# The eBird columns read, the free text ones as text so every chunk of a streamed extract
+# is read with the same types
+eBirdTextColumns = ['observation_count', 'time_observations_started', 'species_comments',
+                    'behavior_code', 'age_sex', 'breeding_code']
+eBirdUsecols = ['eBird_category', 'observation_date', 'BBRC_species'] + list(eBirdColumns.values()) + eBirdTextColumns
+
+def readEBird(eBirdFilePath, chunksize):
+    # Read only the columns the merge needs, either as a single frame or as a stream of
+    # chunks of at most chunksize rows
+    dtypes = {column: str for column in eBirdTextColumns}
+    if chunksize:
+        return pd.read_csv(eBirdFilePath, usecols=eBirdUsecols, dtype=dtypes, chunksize=chunksize)
+    return [pd.read_csv(eBirdFilePath, usecols=eBirdUsecols, dtype=dtypes)]
+
+def toBirdTrack(filtered_df):
+    # Build each BirdTrack column for all the eBird records at once
+    records = {column: filtered_df[eBirdColumn] for column, eBirdColumn in eBirdColumns.items()}
+    records.update({column: value for column, value in constantColumns.items()})
+    records['BOU order'] = filtered_df['bou_order']
+
     # Change X to Present
-    if row['observation_count'] == 'X':
-       count = 'Present'
-    else:
-        count = row['observation_count']
-    
+    records['Count'] = filtered_df['observation_count'].where(filtered_df['observation_count'] != 'X', 'Present')
+
     # Convert start date string to datetime
-    obsDate = datetime.strptime(row['observation_date'], '%d/%m/%Y')
+    records['Date'] = pd.to_datetime(filtered_df['observation_date'], format='%d/%m/%Y')
 
     # Strip seconds from the time string
-    if pd.isna(row['time_observations_started']):
-        startTime = ''
-    else:
-        timeTokens = str(row['time_observations_started']).split(':')
-        startTime = timeTokens[0] + ':' + timeTokens[1]
+    startTimes = filtered_df['time_observations_started']
+    records['Start time'] = startTimes.astype(str).str.split(':').str[:2].str.join(':').where(startTimes.notna(), '')
 
     # Concatenate any values in behaviour code and age/sex into comments
-    if pd.isna(row['species_comments']):
-        comment = ''
-    elif row['species_comments'].isnumeric():
-        comment = str(row['species_comments'])
+    comment = filtered_df['species_comments'].astype(str).where(filtered_df['species_comments'].notna(), '')
+    for eBirdColumn, label in [('behavior_code', 'Behaviour Code'), ('age_sex', 'Age/Sex')]:
+        separator = pd.Series(np.where(comment != '', '; ', ''), index=comment.index)
+        comment = comment.where(filtered_df[eBirdColumn].isna(),
+                                comment + separator + label + '=' + filtered_df[eBirdColumn].astype(str))
+    records['Comment'] = comment
+
+    # Translate breeding code, codes that aren't eBird codes are kept as they are
+    breedingCodes = filtered_df['breeding_code']
+    records['Breeding status'] = breedingCodes.map(breedingCodeDict).fillna(breedingCodes).fillna('')
+
+    # use BBRC in eBird as a proxy for sensitive
+    records['Sensitive'] = np.where(filtered_df['BBRC_species'] == True, 'Y', '')
+
+    return pd.DataFrame(records, index=filtered_df.index)[birdTrackColumns]
+
+def readHeader(workbookFilePath, sheetName):
+    workbook = openpyxl.load_workbook(workbookFilePath, read_only=True)
+    header = list(next(workbook[sheetName].iter_rows(max_row=1, values_only=True)))
+    workbook.close()
+    return header
+
+def writeStreamedWorkbook(workbookFilePath, sheetName, recordFilePaths, renamedColumns):
+    # Copy the workbook to a new write only workbook appending the stored records to the
+    # records sheet (other sheets are copied as values).  Headers and dates are formatted as
+    # pandas' openpyxl writer formats them.  Returns the number of existing and new records
+    source = openpyxl.load_workbook(workbookFilePath, read_only=True)
+    target = openpyxl.Workbook(write_only=True)
+    existingCount = newCount = 0
+    for sourceSheet in source.worksheets:
+        targetSheet = target.create_sheet(sourceSheet.title)
+        rows = sourceSheet.iter_rows(values_only=True)
+        if sourceSheet.title != sheetName:
+            for row in rows:
+                targetSheet.append(row)
+            continue
+        header = list(next(rows))
+        targetSheet.append([styledCell(targetSheet, column, header=True) for column in header])
+        dateColumn = header.index('Date') if 'Date' in header else None
+        for row in rows:
+            row = list(row)
+            # the Date column is converted as pd.read_excel's converter would
+            if dateColumn is not None and isinstance(row[dateColumn], str):
+                row[dateColumn] = pd.to_datetime(row[dateColumn])
+            targetSheet.append([styledCell(targetSheet, value) for value in row])
+            existingCount += 1
+        for recordFilePath in recordFilePaths:
+            records_df = pd.read_pickle(recordFilePath).rename(columns=renamedColumns).reindex(columns=header)
+            for row in records_df.itertuples(index=False, name=None):
+                targetSheet.append([styledCell(targetSheet, value) for value in row])
+            newCount += len(records_df)
+    source.close()
+    # write alongside the original and then replace it
+    temporaryFilePath = pathlib.Path(workbookFilePath).with_suffix('.tmp.xlsx')
+    target.save(temporaryFilePath)
+    os.replace(temporaryFilePath, workbookFilePath)
+    return existingCount, newCount
+
+headerFont = Font(bold=True)
+headerBorder = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+headerAlignment = Alignment(horizontal='center', vertical='top')
+
+def styledCell(sheet, value, header=False):
+    if value is None or value == '' or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        value = value.to_pydatetime()
+    elif isinstance(value, np.generic):
+        value = value.item()
+    cell = WriteOnlyCell(sheet, value=value)
+    if header:
+        cell.font = headerFont
+        cell.border = headerBorder
+        cell.alignment = headerAlignment
+    elif isinstance(value, datetime):
+        cell.number_format = 'YYYY-MM-DD HH:MM:SS'
+    elif isinstance(value, date):
+        cell.number_format = 'YYYY-MM-DD'
+    return cell
+
+parser = argparse.ArgumentParser(description="Merge eBird extract into BirdTrack export",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument("-e", "--ebird_file_path", type=str, required=True,
+                    help='Filepath to the eBird export csv file to be merged from')
+
+parser.add_argument("-b", "--birdtrack_file_path", type=str, required=True,
+                    help='Filepath to the BirdTrack export Excel file to be merged into')
+
+parser.add_argument("-o", "--birdtrack_bou_order_file_path", type=str, required=True,
+                    help='Filepath to the BirdTrack BOU order csv file')
+
+parser.add_argument("-x", "--taxonomy_cache_file_path", type=str, required=False, default=None,
+                    help='Filepath to a cache file for the compiled species taxonomy')
+
+parser.add_argument("-k", "--chunksize", type=int, required=False, default=None,
+                    help='Stream the eBird extract in chunks of this many rows to bound memory use')
+
+parser.add_argument("-d", "--duplicates", type=str, required=False, default='keep', choices=['keep', 'flag', 'suppress'],
+                    help='What to do with eBird records that are likely duplicates of BirdTrack records (same species, date, 1km square and observer)')
+
+parser.add_argument("--count_tolerance", type=float, required=False, default=0.25,
+                    help='Largest difference between the counts of duplicate records as a fraction of the larger count')
+
+parser.add_argument("--time_tolerance", type=int, required=False, default=60,
+                    help='Largest difference in minutes between the start times of duplicate records')
+
+args = parser.parse_args()
+config = vars(args)
+
+# Save a backup of the original file
+backup = args.birdtrack_file_path.replace('.xlsx', '.bak')
+shutil.copyfile(args.birdtrack_file_path, backup)
+print('Backup copy of input BirdTrack data saved as {}'.format(backup))
+
+taxonomy = SpeciesTaxonomy.load(args.birdtrack_bou_order_file_path, args.taxonomy_cache_file_path)
+print('Birdtrack BOU Sequence file read')
+
+# When streaming the converted eBird records are kept in a temporary store
+store = tempfile.TemporaryDirectory(prefix='mergeEBirdToBT') if args.chunksize else None
+
+sheetname = 'Records#1'
+if store is None:
+    birdTrack_df = pd.read_excel(args.birdtrack_file_path, sheet_name=sheetname, converters= {'Date': pd.to_datetime, 'dayfirst': True})
+    print('Birdtrack export file to be merged into already contains {} records'.format(len(birdTrack_df)))
+    birdTrackHeader = list(birdTrack_df.columns)
+else:
+    birdTrackHeader = readHeader(args.birdtrack_file_path, sheetname)
+
+# Line the new records up with the BirdTrack sheet by column name.  A sheet that names its
+# columns differently but has the same layout is lined up by position instead
+missingColumns = [column for column in birdTrackColumns if column not in birdTrackHeader]
+if missingColumns and len(birdTrackHeader) == len(birdTrackColumns):
+    print('BirdTrack export file has no {} columns, matching the columns by position'.format(missingColumns))
+    renamedColumns = dict(zip(birdTrackColumns, birdTrackHeader))
+elif missingColumns:
+    sys.exit('ERROR - BirdTrack export file has no {} columns'.format(missingColumns))
+else:
+    renamedColumns = {}
+
+# Index the existing BirdTrack records to find eBird records that are likely to be the same
+# observations submitted to both
+duplicateIndex = None
+if args.duplicates != 'keep':
+    if store is None:
+        indexed_df = birdTrack_df
     else:
-        comment = row['species_comments']
-    if pd.notna(row['behavior_code']):
-        if comment:
-            comment += '; '
-        comment += 'Behaviour Code={}'.format(row['behavior_code'])
-    if pd.notna(row['age_sex']):
-        if comment:
-            comment += '; '
-        comment += 'Age/Sex={}'.format(row['age_sex'])
-
-    # Translate breeding code
-    if pd.notna(row['breeding_code']):
-        if row['breeding_code'] in eBirdCodes:
-            breedingCode = breedingCodeDict[row['breeding_code']]
+        indexed_df = pd.read_excel(args.birdtrack_file_path, sheet_name=sheetname,
+                                   usecols=[renamedColumns.get(column, column) for column in duplicateColumns])
+    indexed_df = indexed_df.rename(columns={sheetColumn: column for column, sheetColumn in renamedColumns.items()})
+    duplicateIndex = DuplicateIndex(indexed_df, args.count_tolerance, args.time_tolerance)
+    print('Indexed {} BirdTrack records to check for duplicates'.format(len(duplicateIndex)))
+
+# Convert the eBird extract a chunk at a time (the whole extract is one chunk unless
+# streaming).  When streaming the converted records are kept in the store rather than in
+# memory until the workbook is written
+eBirdRecords = []
+eBirdCount = 0
+speciesCount = 0
+missed = pd.Series(dtype='int64')
+duplicateCount = 0
+for eBird_df in readEBird(args.ebird_file_path, args.chunksize):
+    eBirdCount += len(eBird_df)
+
+    #Drop all rows where eBird category is not species'
+    filtered_df = eBird_df[(eBird_df['eBird_category'] == 'species') | eBird_df['eBird_category'].isnull()]
+    speciesCount += len(filtered_df)
+
+    # Attach the BOU order to every row at once with a hashed lookup on scientific name.  Rows
+    # whose scientific name isn't in the BOU order csv are left without one
+    filtered_df = filtered_df.assign(bou_order=taxonomy.bouOrderFor(filtered_df['scientific_name']))
+    chunkMissed = filtered_df.loc[filtered_df['bou_order'].isna(), 'scientific_name'].value_counts(dropna=False)
+    missed = missed.add(chunkMissed, fill_value=0).astype('int64')
+
+    records_df = toBirdTrack(filtered_df)
+    if duplicateIndex is not None:
+        duplicate = duplicateIndex.probe(records_df)
+        duplicateCount += duplicate.sum()
+        if args.duplicates == 'flag':
+            comment = records_df['Comment']
+            records_df.loc[duplicate, 'Comment'] = (comment + np.where(comment != '', '; ', '') + duplicateComment)[duplicate]
         else:
-            breedingCode = row['breeding_code']
+            records_df = records_df[~duplicate]
+    if store is None:
+        eBirdRecords.append(records_df)
     else:
-        breedingCode = ''
+        chunkFilePath = pathlib.Path(store.name) / 'chunk{}.pkl'.format(len(eBirdRecords))
+        records_df.to_pickle(chunkFilePath)
+        eBirdRecords.append(chunkFilePath)
 
-    # use BBRC in eBird as a proxy for sensitive
-    if row['BBRC_species'] == True:
-        sensitive = 'Y'
-    else:
-        sensitive = ''
-    
-    birdTrack_df.loc[len(birdTrack_df.index)] = [btoSpeciesCode, bouOrder, row['species'], row['scientific_name'],
-                                                 row['locality'], row['os1km'], uncertaintyRadius, geometryType,
-                                                 row['latitude'], row['longitude'], pinpoint, row['full_name'],
-                                                 userId, userName, obsDate, startTime,
-                                                 endTime, count, comment, plumage, breedingCode, breedingDetails,
-                                                 sensitive, remarkable, habitatNotes, flight, activity, source,
-                                                 createdDate, obsID, completeList, geometry]
-
-print('Updated BirdTrack export file now contains {} records'.format(len(birdTrack_df)))
-# Overwrite the sheet  
-with pd.ExcelWriter(args.birdtrack_file_path, engine="openpyxl", mode="a", if_sheet_exists="replace", 
-                    date_format='DD/MM/YYYY', datetime_format='HH:MM') as writer:
-    birdTrack_df.to_excel(writer, sheet_name='Records#1', index=False)
+print('eBird file contains {} records'.format(eBirdCount))
+print('eBird file contains {} species records'.format(speciesCount))
+if len(missed) > 0:
+    missed = missed.sort_values(ascending=False, kind='stable')
+    print('Cannot find BOU Order for {} scientific names in {} rows, their BOU order is left blank'.format(len(missed), missed.sum()))
+    for scientificName, rows in missed.items():
+        print('    {} : {} rows'.format(scientificName, rows))
+if duplicateIndex is not None:
+    print('{} eBird records are likely duplicates of BirdTrack records and were {}'.format(
+          duplicateCount, 'flagged in their comment' if args.duplicates == 'flag' else 'left out'))
+
+if store is None:
+    birdTrack_df = pd.concat([birdTrack_df] + [records_df.rename(columns=renamedColumns) for records_df in eBirdRecords],
+                             ignore_index=True)
+    print('Updated BirdTrack export file now contains {} records'.format(len(birdTrack_df)))
+    # Overwrite the sheet
+    with pd.ExcelWriter(args.birdtrack_file_path, engine="openpyxl", mode="a", if_sheet_exists="replace",
+                        date_format='DD/MM/YYYY', datetime_format='HH:MM') as writer:
+        birdTrack_df.to_excel(writer, sheet_name='Records#1', index=False)
+else:
+    # Rewrite the workbook a row at a time so that neither the extract nor the workbook has
+    # to be held in memory
+    existingCount, newCount = writeStreamedWorkbook(args.birdtrack_file_path, sheetname, eBirdRecords, renamedColumns)
+    store.cleanup()
+    print('Birdtrack export file to be merged into already contained {} records'.format(existingCount))
+    print('Updated BirdTrack export file now contains {} records'.format(existingCount + newCount))
 
 runTime = time.time() - start_time
 convert = time.strftime("%H:%M:%S", time.gmtime(runTime))
-print('Execution took {}'.format(convert))
\ No newline at end of file
+print('Execution took {}'.format(convert))
@@ -4,347 +4,340 @@ import argparse
 import pandas as pd
 import datetime
 from datetime import date, datetime
+import glob
+import os
+import pathlib
 import shutil
-import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 from OSGridConverter import latlong2grid
+from speciesTaxonomy import SpeciesTaxonomy
 
-def processIncidentalRowCount(row):
-    count = ''
+def processIncidentalCounts(df):
     # update Y to count of 1.  All examples seen are for count type of individual, present or other singular category
-    if row['Primary Count'] == 'Y':
-        row['Primary Count'] = 1
-    match row['Primary Count Type']:
-        case 'Number':
-            count = row['Primary Count']
-        case 'Estimate':
-            count = 'c' + row['Primary Count']
-        case 'Maximum count':
-            count = 'c' + row['Primary Count']
-        case 'Minimum count':
-            count = row['Primary Count'] + '+'
-        case 'Present':
-            count = row['Primary Count']
-        case _:
-            print('ERROR - Observation Id {} Unknown Count Type detected'.format(row['Observation Id']))
-    return count
-
-def processARMRowCount(row):
-    if row['Primary Count'] == 'Y':
-        count = '2+'
-    else:
-        count = row['Primary Count'] + '+'
-    return count
+    primaryCount = df['Primary Count'].where(df['Primary Count'] != 'Y', 1)
+    countType = df['Primary Count Type']
+    knownType = countType.isin(['Number', 'Estimate', 'Maximum count', 'Minimum count', 'Present'])
+    for observationId in df.loc[~knownType, 'Observation ID']:
+        print('ERROR - Observation Id {} Unknown Count Type detected'.format(observationId))
+    count = np.select([countType.isin(['Number', 'Present']),
+                       countType.isin(['Estimate', 'Maximum count']),
+                       countType == 'Minimum count'],
+                      [primaryCount.to_numpy(dtype=object),
+                       ('c' + primaryCount.astype(str)).to_numpy(dtype=object),
+                       (primaryCount.astype(str) + '+').to_numpy(dtype=object)],
+                      default='')
+    return pd.Series(count, index=df.index, dtype=object)
+
+def processARMCounts(df):
+    return pd.Series(np.where(df['Primary Count'] == 'Y', '2+', df['Primary Count'].astype(str) + '+'),
+                     index=df.index, dtype=object)
 
 def getDuplicates(df):
     #Find the duplicate rows
     all_duplicates_df = df[df.duplicated(subset = ['Species', 'Place', 'Date'], keep=False)]
     return all_duplicates_df
 
+duplicateColumns = ['Species', 'Place', 'Date', 'Observer']
+
 def removeDuplicates(df):
     # Append the Observer ID to the place name to make multiple counts for the same species
-    # on the same data at the same place unique.
-    # Find the duplicate rows
-    df.sort_values(by = ['Species', 'Place', 'Date'])
-    all_duplicates_df = df[df.duplicated(subset = ['Species', 'Place', 'Date', 'Observer'], keep=False)]
-   # Get a list of unique species
-    speciesList = all_duplicates_df.Species.unique()
-    # For each species find rows with duplicate dates and places
-    for species in speciesList:
-        # Create a df containing just the rows for that species
-        species_df = all_duplicates_df[all_duplicates_df['Species'] == species]
-        # Get a list of unique places
-        placesList = species_df.Place.unique()
-        # For each place get a list of rows with duplicated dates
-        for place in placesList:
-            # create a df containing just the rows for that place
-            place_df = species_df[species_df['Place'] == place]
-            # get a list of dates for that place
-            dateList = place_df.Date.unique()
-            for date in dateList:
-                # create a df containing just the rows for that date
-                date_df = place_df[place_df['Date'] == date]
-                # get a list of observers for that date
-                observerList = date_df.Observer.unique()
-                for observer in observerList:
-                    # create a df containing just the rows for that observer
-                    observer_df = date_df[date_df['Observer'] == observer]
-                    for row in observer_df:
-                        duplicate_filter = (df['Species'] == species) & (df['Place'] == place) & (df['Date'] == date) & (df['Observer'] == observer)
-                        df.loc[duplicate_filter, 'Place'] = df.loc[duplicate_filter, 'Place'] + ' - ' + df.loc[duplicate_filter, 'ObsId']
-    return df
-
-def setBreeding(row):
-    breeding = ''
-    if pd.notna(row['Fledged Max']) and row['Fledged Max'] > 0:
-        breeding = '12'
-    elif pd.notna(row['Chicks Max']) and row['Chicks Max'] > 0:
-        breeding = '16'
-    else:
-        if 'ARM Species Records' in row['Dataset']:
-            if pd.notna(row['Primary Count Unit']):
-                if row['Primary Count Unit'] == 'Singing/Displaying male':
-                    breeding = '02'
-                elif row['Primary Count Unit'] == 'Pair':
-                    breeding = '03'
-                elif row['Primary Count Unit'] == 'Recently hatched chick' or \
-                    row['Primary Count Unit'] == 'Adult(s) with brood' or \
-                    row['Primary Count Unit'] == 'Chick' or \
-                    row['Primary Count Unit'] == 'Part grown chick':
-                    breeding = '16'
-                elif row['Primary Count Unit'] == 'Apparently occupied territory':
-                    breeding = '04'
-                elif row['Primary Count Unit'] == 'Apparently occupied burrow' or \
-                    row['Primary Count Unit'] == 'Apparently occupied nest':
-                    breeding = '13'
-        else:
-            # (breeding) Activity populated in incidental records
-            if pd.notna(row['Activity']):
-                if row['Activity'] == 'Singing':
-                    breeding = '02'
-                elif row['Activity'] == 'Adults carrying faecal sac or food for young':
-                    breeding = '14'
-                elif row['Activity'] == 'Nest under construction' or row['Activity'] == 'Nest building or excavating':
-                    breeding = '09'
-                elif row['Activity'] == 'Visiting nest site':
-                    breeding = '06'
-                elif row['Activity'] == 'Mating' or row['Activity'] == 'Displaying':
-                    breeding = '05'
-                elif row['Activity'] == 'Family party':
-                    breeding = '12'
-                elif row['Activity'] == 'Apparently incubating':
-                    breeding = '15'
-                elif row['Activity'] == 'Adult observed incubating eggs/chicks':
-                    breeding = '16'
-    return breeding
-
-def setActivity(row):
-    activity = ''
-    if pd.notna(row['Activity']):
-        if row['Activity'] == 'Feeding/Drinking' or \
-           row['Activity'] == 'Hunting':
-           activity = '1'
-        elif row['Activity'] == 'In flight':
-           activity = '2'
-        elif row['Activity'] == 'At roost':
-           activity = '4'
-        elif row['Activity'] == 'Apparently incubating' or \
-             row['Activity'] == 'Adult observed incubating eggs/chicks':
-             activity = '7'
-    return activity
-
-
-parser = argparse.ArgumentParser(description="Reformat RSPB Data for Birdtrack upload",
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-parser.add_argument("-i", "--input_file_path", type=str, required=True, help='Filepath to the RSPB Excel file to be processed')
-parser.add_argument("-o", "--output_file_path", type=str, required=True, help='Filepath to the Birdtrack upload Excel file to be created')
-parser.add_argument("-y", "--year", type=str, required=True, help='Year to be used for ARM dates spanning the whole year')
-
-
-args = parser.parse_args()
-config = vars(args)
-
-input_df = pd.read_excel(args.input_file_path, sheet_name='Export')
-
-# Make the Observation Id a string
-input_df['Observation ID'] = input_df['Observation ID'].apply(str)
-
-# Convert the eggs, chicks and fledged max fields to ints
-input_df['Eggs Min'] = input_df['Eggs Min'].astype('Int16')
-input_df['Eggs Max'] = input_df['Eggs Max'].astype('Int16')
-input_df['Chicks Min'] = input_df['Chicks Min'].astype('Int16')
-input_df['Chicks Max'] = input_df['Chicks Max'].astype('Int16')
-input_df['Fledged Min'] = input_df['Fledged Min'].astype('Int16')
-input_df['Fledged Max'] = input_df['Fledged Max'].astype('Int16')
-input_df['AssCount Count Value'] = input_df['AssCount Count Value'].astype('Int16')
-
-
-
-arm_output_df = pd.DataFrame(columns=['Species', 'Count', 'Place', 'Latitude', 'Longitude', 'Date', 'Breeding evidence', 'Comment', 'Observer',
-                                      'Sensitive', 'Activity', 'Age_Sex_Plumage', 'Source', 'ObsId'])
-non_arm_output_df = pd.DataFrame(columns=['Species', 'Count', 'Place', 'Latitude', 'Longitude', 'Date', 'Breeding evidence', 'Comment', 'Observer',
-                                          'Sensitive', 'Activity', 'Age_Sex_Plumage', 'Source', 'ObsId'])
-
-residents = ['Black Grouse', 'Black-headed Gull', 'Blackbird', 'Blue Tit', 'Bullfinch', 'Buzzard', 'Canada Goose', 'Carrion Crow',
-             'Chaffinch', 'Coal Tit', 'Collared Dove', 'Coot', 'Dipper', 'Dunnock', 'Gadwall', 'Goldcrest', 'Goldeneye',
-             'Goldfinch', 'Goosander', 'Great Crested Grebe', 'Great Spotted Woodpecker', 'Great Tit', 'Greenfinch', 'Greylag Goose',
-             'House Sparrow', 'Jackdaw', 'Jay', 'Kestrel', 'Kingfisher', 'Lapwing', 'Lesser Redpoll', 'Little Grebe', 'Long-tailed Tit',
-             'Magpie', 'Mallard', 'Meadow Pipit', 'Mistle Thrush', 'Moorhen', 'Mute Swan', 'Nuthatch', 'Oystercatcher', 'Peregrine',
-             'Pheasant', 'Pied Wagtail', 'Raven', 'Redshank', 'Reed Bunting', 'Robin', 'Shoveler', 'Siskin',
-             'Skylark', 'Snipe', 'Song Thrush', 'Sparrowhawk', 'Starling', 'Stonechat', 'Tawny Owl', 'Teal', 'Treecreeper',
-             'Tufted Duck', 'Water Rail', 'Wigeon', 'Woodcock', 'Woodpigeon', 'Wren']
-migrants = ['Blackcap', 'Chiffchaff', 'Common Sandpiper', 'Cuckoo', 'Garden Warbler', 'Grasshopper Warbler', 'Little Ringed Plover', 'Osprey',
-            'Pied Flycatcher', 'Redstart', 'Sand Martin', 'Sedge Warbler', 'Spotted Crake', 'Spotted Flycatcher', 'Swallow', 'Tree Pipit', 'Whitethroat',
-             'Willow Warbler', 'Wood Warbler']
-
-dateForResidents = '15/04/{}'.format(args.year)
-dateForMigrants = '01/06/{}'.format(args.year)
-
-for index, row in input_df.iterrows():
-
-    # Count and Date
-    if 'ARM Species Records' in row['Dataset']:
-        count = processARMRowCount(row)
-        if row['Common Name'] in residents:
-            rowDate = datetime.strptime(dateForResidents, '%d/%m/%Y').date()
-        elif row['Common Name'] in migrants:
-            rowDate = datetime.strptime(dateForMigrants, '%d/%m/%Y').date()
-        else:
-            print('Error - ARM record species {} not in residents or migrants'.format(row['Common Name']))
-    else:
-        count = processIncidentalRowCount(row)
-        rowDate = datetime.strptime(row['Start Date'].strftime("%d/%m/%Y"), '%d/%m/%Y').date()
-
-    # Place
-    place = re.search(r',?\s*([\w\']*\s*\w*\sRSPB)', row['Dataset']).group(1)
-    if 'ARM Species Records' not in row['Dataset']:    
-        if pd.notna(row['Feature']) and not re.match(r'^\d+[a-z]?$', row['Feature']) and not row['Feature'] == 'DO NOT USE ':
-            place += ', ' + row['Feature']
-        if pd.notna(row['Location']):
-            place += ', ' + row['Location']
-    else:
-        if pd.notna(row['Feature Types']):
-            place += ' - ' +row['Feature Types']
-
-    # Comment
-    comments = []
-    if 'ARM Species Records' in row['Dataset']:
-        if row['Primary Count Unit'] == 'Pair':
-            if row['Primary Count'] == '1':
-                comments.append(row['Primary Count'] + ' ' + row['Primary Count Unit'])
-            else:
-                comments.append(row['Primary Count'] + ' ' + row['Primary Count Unit'] + 's')
-        else:
-            if pd.notna(row['Status']) and row['Status'] != 'Unknown':
-                comments.append(row['Status'])
-    else:
-        if pd.notna(row['Primary Count Comment']):
-            comments.append(row['Primary Count Comment'])
-        if pd.notna(row['Status']) and row['Status'] != 'Unknown':
-            comments.append(row['Status'])
-    if pd.notna(row['Comments']):
-        comments.append(row['Comments'])
-    if pd.notna(row['Activity']) and \
-       row['Activity'] != 'Not recorded':
-        comments.append(row['Activity'])
-    if pd.notna(row['Chicks Min']):
-        comments.append('Chicks Min: {}'.format(row['Chicks Min']))
-    if pd.notna(row['Chicks Max']):
-        comments.append('Chicks Max: {}'.format(row['Chicks Max']))
-    if pd.notna(row['Chicks Present']):
-        comments.append('Chicks Present: {}'.format(row['Chicks Present']))
-    if pd.notna(row['Fledged Min']):
-        comments.append('Fledged Min: {}'.format(row['Fledged Min']))
-    if pd.notna(row['Fledged Max']):
-        comments.append('Fledged Max: {}'.format(row['Fledged Max'])) 
-    if pd.notna(row['Fledged Present']):
-        comments.append('Fledged Present: {}'.format(row['Fledged Present']))
-    if pd.notna(row['AssCount Count Unit']):
-        comments.append('AssCount Count: {} = {}'.format(row['AssCount Count Unit'], row['AssCount Count Value']))
-    if pd.notna(row['AssCount Breeding Status Code']):
-        comments.append('AssCount Breeding Status Code: {}'.format(row['AssCount Breeding Status Code']))
-    if pd.notna(row['AssCount Activity Type Code']) and \
-       row['AssCount Activity Type Code'] != 'Not recorded':
-        comments.append('AssCount Activity Type Code: {}'.format(row['AssCount Activity Type Code']))
-    if row['Primary Count Unit'] == 'Adult Male' or row['Primary Count Unit'] == 'Adult Female':
-        comments.append('Count is of {}'.format(row['Primary Count Unit']))
+    # on the same date at the same place by the same observer unique.
+    # Number every (species, place, date, observer) group in one pass and tag the rows of
+    # groups with more than one row.  Groups with a missing key are left alone.
+    groupIds = df.groupby(duplicateColumns, sort=False, dropna=False).ngroup().to_numpy()
+    isDuplicate = np.bincount(groupIds, minlength=1)[groupIds] > 1
+    hasKeys = df[duplicateColumns].notna().all(axis=1).to_numpy()
+    tagged = isDuplicate & hasKeys
+    df.loc[tagged, 'Place'] = df.loc[tagged, 'Place'] + ' - ' + df.loc[tagged, 'ObsId']
+    # Tagged rows sharing an ObsId and the untagged duplicates are still duplicates
+    obsIdGroupIds = df.groupby([groupIds, df['ObsId'].to_numpy()], sort=False).ngroup().to_numpy()
+    sharesObsId = np.bincount(obsIdGroupIds, minlength=1)[obsIdGroupIds] > 1
+    remaining = int(((tagged & sharesObsId) | (isDuplicate & ~hasKeys)).sum())
+    return df, remaining
+
+# Breeding evidence and activity codes.  Breeding evidence is the code of the first count
+# column with a count above zero, otherwise the code for the primary count unit of ARM
+# records or for the (breeding) activity of incidental records.  A csv of table, value,
+# code rows passed with --codes_file_path adds to or replaces these entries.
+codeTables = {'count'             : {'Fledged Max'                                  : '12',
+                                     'Chicks Max'                                   : '16'},
+              'unit'              : {'Singing/Displaying male'                      : '02',
+                                     'Pair'                                         : '03',
+                                     'Recently hatched chick'                       : '16',
+                                     'Adult(s) with brood'                          : '16',
+                                     'Chick'                                        : '16',
+                                     'Part grown chick'                             : '16',
+                                     'Apparently occupied territory'                : '04',
+                                     'Apparently occupied burrow'                   : '13',
+                                     'Apparently occupied nest'                     : '13'},
+              'breeding activity' : {'Singing'                                      : '02',
+                                     'Adults carrying faecal sac or food for young' : '14',
+                                     'Nest under construction'                      : '09',
+                                     'Nest building or excavating'                  : '09',
+                                     'Visiting nest site'                           : '06',
+                                     'Mating'                                       : '05',
+                                     'Displaying'                                   : '05',
+                                     'Family party'                                 : '12',
+                                     'Apparently incubating'                        : '15',
+                                     'Adult observed incubating eggs/chicks'        : '16'},
+              'activity'          : {'Feeding/Drinking'                             : '1',
+                                     'Hunting'                                      : '1',
+                                     'In flight'                                    : '2',
+                                     'At roost'                                     : '4',
+                                     'Apparently incubating'                        : '7',
+                                     'Adult observed incubating eggs/chicks'        : '7'}}
+
+def loadCodeTables(filePath=None):
+    tables = {name: dict(table) for name, table in codeTables.items()}
+    if filePath is not None:
+        # keep the codes as text so that 02 stays 02
+        codes_df = pd.read_csv(filePath, dtype=str, keep_default_na=False)
+        unknownTables = set(codes_df['table']) - set(tables)
+        if unknownTables:
+            sys.exit('ERROR - unknown code tables {} in {}, expected {}'.format(sorted(unknownTables), filePath, list(tables)))
+        for table, value, code in codes_df[['table', 'value', 'code']].itertuples(index=False):
+            tables[table][value] = code
+    return tables
+
+def setBreeding(df, isARM, tables):
+    breeding = np.full(len(df), '', dtype=object)
+    decided = np.zeros(len(df), dtype=bool)
+    # earlier count columns take precedence
+    for column, code in tables['count'].items():
+        hasCount = (df[column] > 0).fillna(False).to_numpy(dtype=bool) & ~decided
+        breeding[hasCount] = code
+        decided |= hasCount
+    fromUnit = df['Primary Count Unit'].map(tables['unit']).to_numpy(dtype=object)
+    fromActivity = df['Activity'].map(tables['breeding activity']).to_numpy(dtype=object)
+    fallback = pd.Series(np.where(isARM, fromUnit, fromActivity), index=df.index).fillna('')
+    return pd.Series(np.where(decided, breeding, fallback.to_numpy(dtype=object)), index=df.index, dtype=object)
+
+def setActivity(df, tables):
+    return df['Activity'].map(tables['activity']).fillna('').astype(object)
+
+def isARMRecord(datasets):
+    return datasets.str.contains('ARM Species Records', regex=False).to_numpy(dtype=bool)
+
+placeColumns = ['Dataset', 'Feature', 'Feature Types', 'Location']
+
+def buildPlaces(df, isARM):
+    # The reserve name from the dataset, then the feature and location for incidental records
+    # and the feature types for ARM records
+    place = df['Dataset'].str.extract(r',?\s*([\w\']*\s*\w*\sRSPB)', expand=False)
+    feature = df['Feature']
+    useFeature = feature.notna() & ~feature.astype(str).str.match(r'^\d+[a-z]?$') & (feature != 'DO NOT USE ')
+    place = place.where(~(~isARM & useFeature), place + ', ' + feature.astype(str))
+    location = df['Location']
+    place = place.where(~(~isARM & location.notna()), place + ', ' + location.astype(str))
+    featureTypes = df['Feature Types']
+    place = place.where(~(isARM & featureTypes.notna()), place + ' - ' + featureTypes.astype(str))
+    return place
+
+def setPlaces(df):
+    # An export only has a few distinct datasets, features and locations so each place is
+    # built once per distinct combination and then taken for every record
+    placeIds = df.groupby(placeColumns, sort=False, dropna=False).ngroup().to_numpy()
+    _, firstRows = np.unique(placeIds, return_index=True)
+    distinct_df = df.iloc[firstRows]
+    places = buildPlaces(distinct_df, isARMRecord(distinct_df['Dataset']))
+    # Report the datasets with no reserve name, their records are left without a place
+    missed = places.isna().to_numpy()
+    if missed.any():
+        records = pd.Series(np.bincount(placeIds)[missed], index=distinct_df['Dataset'].to_numpy()[missed])
+        records = records.groupby(level=0, dropna=False).sum()
+        print('ERROR - no RSPB reserve found in the Dataset of {} records, their Place is left blank'.format(records.sum()))
+        for dataset, count in records.items():
+            print('    {} : {} records'.format(dataset, count))
+    return pd.Series(places.to_numpy(dtype=object)[placeIds], index=df.index, dtype=object)
+
+def joinComments(pieces, index):
+    # Join each row's comment pieces that are present with '; '
+    comment = pd.Series('', index=index, dtype=object)
+    for present, piece in pieces:
+        present = np.asarray(present, dtype=bool)
+        separator = np.where(comment[present] != '', '; ', '')
+        comment[present] = comment[present] + separator + piece[present].astype(str)
+    return comment
+
+def setComments(df, isARM):
+    unit = df['Primary Count Unit']
+    isPair = isARM & (unit == 'Pair')
+    validStatus = df['Status'].notna() & (df['Status'] != 'Unknown')
+    pieces = [(isPair, df['Primary Count'].astype(str) + ' ' + unit + np.where(df['Primary Count'] == '1', '', 's')),
+              (~isARM & df['Primary Count Comment'].notna(), df['Primary Count Comment']),
+              (~isPair & validStatus, df['Status']),
+              (df['Comments'].notna(), df['Comments']),
+              (df['Activity'].notna() & (df['Activity'] != 'Not recorded'), df['Activity'])]
+    for column in ['Chicks Min', 'Chicks Max', 'Chicks Present', 'Fledged Min', 'Fledged Max', 'Fledged Present']:
+        pieces.append((df[column].notna(), column + ': ' + df[column].astype(str)))
+    pieces += [(df['AssCount Count Unit'].notna(),
+                'AssCount Count: ' + df['AssCount Count Unit'].astype(str) + ' = ' + df['AssCount Count Value'].astype(str)),
+               (df['AssCount Breeding Status Code'].notna(),
+                'AssCount Breeding Status Code: ' + df['AssCount Breeding Status Code'].astype(str)),
+               (df['AssCount Activity Type Code'].notna() & (df['AssCount Activity Type Code'] != 'Not recorded'),
+                'AssCount Activity Type Code: ' + df['AssCount Activity Type Code'].astype(str)),
+               (unit.isin(['Adult Male', 'Adult Female']), 'Count is of ' + unit.astype(str))]
     # if pd.notna(row['AssCount Comment']):
     #     comments.append('AssCount Comment: {}'.format(row['AssCount Comment']))
-    comment = '; '.join(comments)
+    return joinComments(pieces, df.index)
 
-    # Observer
-    if row['Observer'] == 'Visitor' or \
-       row['Observer'] == 'Unknown' or \
-       row['Observer'].startswith('RSPB'):
-        observer = 'RSPB'
-    else:
-        observer = row['Observer']
+def convertExport(inputFilePath, year, taxonomy, tables):
+    # Convert one RSPB export into BirdTrack records, returned as the ARM and non-ARM records
+    # with the observation ids still attached for removeDuplicates
+    print('Converting {} with ARM records dated in {}'.format(inputFilePath, year))
+    input_df = pd.read_excel(inputFilePath, sheet_name='Export')
 
-    # Sensitive 
-    if row['Sensitivity'] == 'RESTRICTED' or \
-       row['Sensitivity'] == 'SENSITIVE':
-        sensitive = 'Y'
-    else:
-        sensitive = ''
+    # Make the Observation Id a string
+    input_df['Observation ID'] = input_df['Observation ID'].apply(str)
+
+    # Convert the eggs, chicks and fledged max fields to ints
+    input_df['Eggs Min'] = input_df['Eggs Min'].astype('Int16')
+    input_df['Eggs Max'] = input_df['Eggs Max'].astype('Int16')
+    input_df['Chicks Min'] = input_df['Chicks Min'].astype('Int16')
+    input_df['Chicks Max'] = input_df['Chicks Max'].astype('Int16')
+    input_df['Fledged Min'] = input_df['Fledged Min'].astype('Int16')
+    input_df['Fledged Max'] = input_df['Fledged Max'].astype('Int16')
+    input_df['AssCount Count Value'] = input_df['AssCount Count Value'].astype('Int16')
+
+    # Classify the species once for the whole input against the shared taxonomy
+    isResident = taxonomy.isClass(input_df['Common Name'], 'resident')
+    isMigrant = taxonomy.isClass(input_df['Common Name'], 'migrant')
+    isARM = isARMRecord(input_df['Dataset'])
+
+    dateForResidents = datetime.strptime('15/04/{}'.format(year), '%d/%m/%Y').date()
+    dateForMigrants = datetime.strptime('01/06/{}'.format(year), '%d/%m/%Y').date()
+
+    # Each output column is built for the whole input at once and the ARM and non-ARM records
+    # are then split from the one frame
+
+    # Count and Date
+    count = processIncidentalCounts(input_df[~isARM]).reindex(input_df.index)
+    count[isARM] = processARMCounts(input_df[isARM])
+    rowDate = pd.Series(input_df['Start Date'].dt.date, index=input_df.index, dtype=object)
+    rowDate[isARM & isResident] = dateForResidents
+    rowDate[isARM & ~isResident & isMigrant] = dateForMigrants
+    unclassified = isARM & ~isResident & ~isMigrant
+    for species in input_df.loc[unclassified, 'Common Name']:
+        print('Error - ARM record species {} not in residents or migrants'.format(species))
+    rowDate[unclassified] = None
+
+    # Observer
+    observer = input_df['Observer']
+    observer = observer.where(~(observer.isin(['Visitor', 'Unknown']) | observer.str.startswith('RSPB', na=False)), 'RSPB')
 
     # Age and Plumage
-    ageAndPlumage = ''
-    if row['Primary Count Unit'] == 'Adult Male':
-        ageAndPlumage = '[{{"SEX":"M","COUNT":"{}"}}]'.format(count)
-    if row['Primary Count Unit'] == 'Adult Female':
-        ageAndPlumage = '[{{"SEX":"F","COUNT":"{}"}}]'.format(count)
-
-    # Breeding
-    breeding = setBreeding(row)
-
-    # Activity
-    activity = setActivity(row)
-
-    # Write to the output DF
-    if 'ARM Species Records' in row['Dataset']:
-        arm_output_df.loc[index] = {'Species'           : row['Common Name'],
-                                    'Count'             : count,
-                                    'Place'             : place,
-                                    'Latitude'          : row['Latitude'],
-                                    'Longitude'         : row['Longitude'],
-                                    'Date'              : rowDate,
-                                    'Comment'           : comment,
-                                    'Observer'          : observer,
-                                    'Sensitive'         : sensitive,
-                                    'Source'            : 'RSPB',
-                                    'ObsId'             : row['Observation ID'],
-                                    'Age and plumage'   : ageAndPlumage,
-                                    'Breeding evidence' : breeding,
-                                    'Activity'          : activity}
+    unit = input_df['Primary Count Unit']
+    ageAndPlumage = pd.Series('', index=input_df.index, dtype=object)
+    ageAndPlumage[unit == 'Adult Male'] = '[{"SEX":"M","COUNT":"' + count[unit == 'Adult Male'].astype(str) + '"}]'
+    ageAndPlumage[unit == 'Adult Female'] = '[{"SEX":"F","COUNT":"' + count[unit == 'Adult Female'].astype(str) + '"}]'
+
+    output_df = pd.DataFrame({'Species'           : input_df['Common Name'],
+                              'Count'             : count,
+                              'Place'             : setPlaces(input_df),
+                              'Latitude'          : input_df['Latitude'],
+                              'Longitude'         : input_df['Longitude'],
+                              'Date'              : rowDate,
+                              'Breeding evidence' : setBreeding(input_df, isARM, tables),
+                              'Comment'           : setComments(input_df, isARM),
+                              'Observer'          : observer,
+                              'Sensitive'         : np.where(input_df['Sensitivity'].isin(['RESTRICTED', 'SENSITIVE']), 'Y', ''),
+                              'Activity'          : setActivity(input_df, tables),
+                              'Age_Sex_Plumage'   : ageAndPlumage,
+                              'Source'            : 'RSPB',
+                              'ObsId'             : input_df['Observation ID']})
+
+    return output_df[isARM], output_df[~isARM]
+
+def findExports(inputPath):
+    # A single export, every export in a directory or the exports matching a glob
+    path = pathlib.Path(inputPath)
+    if path.is_file():
+        return [path]
+    if path.is_dir():
+        filePaths = sorted(path.glob('*.xlsx'))
+    else:
+        filePaths = sorted(pathlib.Path(filePath) for filePath in glob.glob(inputPath))
+    # Skip the outputs of earlier runs and Excel lock files
+    return [filePath for filePath in filePaths if not filePath.name.startswith(('ARM_', 'Non_ARM_', '~$'))]
+
+def exportYears(filePaths, year, yearMappingFilePath):
+    # The year for each export from the mapping csv of file, year rows (matched on the file
+    # name with or without its extension) falling back to --year
+    mapping = {}
+    if yearMappingFilePath is not None:
+        mapping_df = pd.read_csv(yearMappingFilePath, dtype=str)
+        mapping = dict(zip(mapping_df['file'], mapping_df['year']))
+    years = [mapping.get(filePath.name, mapping.get(filePath.stem, year)) for filePath in filePaths]
+    missing = [filePath.name for filePath, exportYear in zip(filePaths, years) if exportYear is None]
+    if missing:
+        sys.exit('ERROR - no year given for {}, use --year or --year_mapping_file_path'.format(', '.join(missing)))
+    return years
+
+def writeOutput(output_df, outputFilePath):
+    # Create a Pandas Excel writer using XlsxWriter as the engine.
+    writer = pd.ExcelWriter(outputFilePath, engine="xlsxwriter", date_format='DD/MM/YYYY')
+    # Convert the dataframe to an XlsxWriter Excel object.
+    output_df.to_excel(writer, sheet_name="Sheet1", index=False)
+    # Close the Pandas Excel writer and output the Excel file.
+    writer.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reformat RSPB Data for Birdtrack upload",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-i", "--input_file_path", type=str, required=True, help='Filepath to the RSPB Excel file to be processed, or a directory or glob of RSPB Excel files to be processed together')
+    parser.add_argument("-o", "--output_file_path", type=str, required=True, help='Filepath to the Birdtrack upload Excel file to be created')
+    parser.add_argument("-y", "--year", type=str, required=False, help='Year to be used for ARM dates spanning the whole year')
+    parser.add_argument("-m", "--year_mapping_file_path", type=str, required=False, help='Filepath to a csv of file, year rows giving the year of each RSPB Excel file (others use --year)')
+    parser.add_argument("-w", "--workers", type=int, required=False, default=os.cpu_count(), help='Number of processes used to convert several RSPB Excel files')
+    parser.add_argument("-c", "--codes_file_path", type=str, required=False, help='Filepath to a csv of table, value, code rows adding to or replacing the breeding and activity codes')
+
+    args = parser.parse_args()
+    config = vars(args)
+
+    inputFilePaths = findExports(args.input_file_path)
+    if not inputFilePaths:
+        sys.exit('ERROR - no RSPB Excel files found in {}'.format(args.input_file_path))
+    years = exportYears(inputFilePaths, args.year, args.year_mapping_file_path)
+
+    taxonomy = SpeciesTaxonomy()
+    tables = loadCodeTables(args.codes_file_path)
+
+    # Convert the exports across a pool of processes when there is more than one
+    if len(inputFilePaths) > 1 and args.workers > 1:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(inputFilePaths))) as executor:
+            outputs = list(executor.map(convertExport, inputFilePaths, years,
+                                        repeat(taxonomy), repeat(tables)))
     else:
-        non_arm_output_df.loc[index] = {'Species'           : row['Common Name'],
-                                        'Count'             : count,
-                                        'Place'             : place,
-                                        'Latitude'          : row['Latitude'],
-                                        'Longitude'         : row['Longitude'],
-                                        'Date'              : rowDate,
-                                        'Comment'           : comment,
-                                        'Observer'          : observer,
-                                        'Sensitive'         : sensitive,
-                                        'Source'            : 'RSPB',
-                                        'ObsId'             : row['Observation ID'],
-                                        'Age and plumage'   : ageAndPlumage,
-                                        'Breeding evidence' : breeding,
-                                        'Activity'          : activity}
-
-# Now remove the duplicates by appending the RSPB observation id to the place name
-arm_output_df = removeDuplicates(arm_output_df)
-non_arm_output_df = removeDuplicates(non_arm_output_df)
-# Drop the observation column as it's not needed any more
-arm_output_df = arm_output_df.drop('ObsId', axis=1)
-non_arm_output_df = non_arm_output_df.drop('ObsId', axis=1)
-
-# Report any remaining duplicates
-arm_duplicate_count = len(arm_output_df[arm_output_df.duplicated(subset = ['Species', 'Place', 'Date','Observer'], keep=False)])
-non_arm_duplicate_count = len(non_arm_output_df[non_arm_output_df.duplicated(subset = ['Species', 'Place', 'Date', 'Observer'], keep=False)])
-
-print('There are {} duplicates remaining in the arm output'.format(arm_duplicate_count))
-print('There are {} duplicates remaining in the non-arm output'.format(non_arm_duplicate_count))
-
-# Write the output file
-arm_output_file_path = 'ARM_' + args.output_file_path
-non_arm_output_file_path = 'Non_ARM_' + args.output_file_path
-
-# Create a Pandas Excel writer using XlsxWriter as the engine.
-writer1 = pd.ExcelWriter(arm_output_file_path, engine="xlsxwriter", date_format='DD/MM/YYYY')
-writer2 = pd.ExcelWriter(non_arm_output_file_path, engine="xlsxwriter", date_format='DD/MM/YYYY')
-
-# Convert the dataframe to an XlsxWriter Excel object.
-arm_output_df.to_excel(writer1, sheet_name="Sheet1", index=False)
-non_arm_output_df.to_excel(writer2, sheet_name="Sheet1", index=False)
-
-# Get the xlsxwriter workbook and worksheet objects.
-workbook1 = writer1.book
-workbook2 = writer2.book
-
-worksheet1 = writer1.sheets["Sheet1"]
-worksheet2 = writer2.sheets["Sheet1"]
-
-# Close the Pandas Excel writer and output the Excel file.
-writer1.close()
-writer2.close()
\ No newline at end of file
+        outputs = list(map(convertExport, inputFilePaths, years, repeat(taxonomy), repeat(tables)))
+
+    # Combine the exports so that duplicates across exports are caught too, remembering which
+    # export each record came from
+    arm_output_df = pd.concat([arm_df for arm_df, _ in outputs], keys=range(len(outputs)), names=['Export', None])
+    non_arm_output_df = pd.concat([non_arm_df for _, non_arm_df in outputs], keys=range(len(outputs)), names=['Export', None])
+
+    # Now remove the duplicates by appending the RSPB observation id to the place name
+    arm_output_df, arm_duplicate_count = removeDuplicates(arm_output_df)
+    non_arm_output_df, non_arm_duplicate_count = removeDuplicates(non_arm_output_df)
+    # Drop the observation column as it's not needed any more
+    arm_output_df = arm_output_df.drop('ObsId', axis=1)
+    non_arm_output_df = non_arm_output_df.drop('ObsId', axis=1)
+
+    # Report any remaining duplicates
+    print('There are {} duplicates remaining in the arm output'.format(arm_duplicate_count))
+    print('There are {} duplicates remaining in the non-arm output'.format(non_arm_duplicate_count))
+
+    # Write the combined pair of output files, then a pair per export when there are several.
+    # An export may have no ARM or no incidental records, which gives an empty sheet
+    writeOutput(arm_output_df, 'ARM_' + args.output_file_path)
+    writeOutput(non_arm_output_df, 'Non_ARM_' + args.output_file_path)
+    if len(inputFilePaths) > 1:
+        armExports = arm_output_df.index.get_level_values('Export')
+        nonArmExports = non_arm_output_df.index.get_level_values('Export')
+        for export, inputFilePath in enumerate(inputFilePaths):
+            exportFilePath = inputFilePath.stem + '_' + args.output_file_path
+            writeOutput(arm_output_df[armExports == export], 'ARM_' + exportFilePath)
+            writeOutput(non_arm_output_df[nonArmExports == export], 'Non_ARM_' + exportFilePath)
@@ -0,0 +1,92 @@
+# Detects records submitted to both BirdTrack and eBird so that merging an eBird extract into
+# a BirdTrack export doesn't count the same birds twice.
+#
+# DuplicateIndex hashes the existing BirdTrack records on blocking keys (scientific name,
+# date, 1km square and normalised observer name) and is then probed with the incoming
+# records, so the cost grows linearly with the number of records rather than with the
+# product of the two.  Records sharing all the keys are likely duplicates when their counts
+# and start times are also within the given tolerances.  Records missing any of the keys are
+# never treated as duplicates.
+
+import re
+import numpy as np
+import pandas as pd
+
+def perDistinct(values, function):
+    # Apply a function to each distinct value once and broadcast the result back
+    codes, uniques = pd.factorize(values)
+    results = np.array([function(value) for value in uniques] + [None], dtype=object)
+    return pd.Series(results[codes], index=values.index)
+
+def oneKmSquare(gridRef):
+    # TG 51408 13177, TG5140813177, TG514131 and TG5113 all become TG5113
+    match = re.fullmatch(r'([A-Z]{2})(\d+)', re.sub(r'\s+', '', str(gridRef)).upper())
+    if match is None or len(match.group(2)) % 2 != 0 or len(match.group(2)) < 4:
+        return None
+    digits = match.group(2)
+    half = len(digits) // 2
+    return match.group(1) + digits[:2] + digits[half:half + 2]
+
+def observerKey(observer):
+    # Lower case name tokens in sorted order so that 'Jo Bloggs' and 'Bloggs, Jo' match
+    tokens = re.findall(r'[a-z]+', str(observer).lower())
+    return ' '.join(sorted(tokens)) if tokens else None
+
+def blockingKeys(df):
+    # One key per record joining the blocking columns, None where any of them is missing
+    dates = pd.to_datetime(df['Date'], errors='coerce').dt.strftime('%Y-%m-%d')
+    parts = [perDistinct(df['Scientific name'], lambda name: str(name).strip().lower() or None),
+             dates.astype(object).where(dates.notna(), None),
+             perDistinct(df['Grid reference'], oneKmSquare),
+             perDistinct(df['Observer name'], observerKey)]
+    key = parts[0].astype(str)
+    for part in parts[1:]:
+        key = key + '|' + part.astype(str)
+    complete = np.logical_and.reduce([part.notna().to_numpy() for part in parts])
+    return key.where(complete, None)
+
+def numericCounts(counts):
+    # Counts as numbers, NaN where the count isn't a number (Present, c50, 10+ ...)
+    return pd.to_numeric(counts, errors='coerce').to_numpy(dtype=float)
+
+def startMinutes(startTimes):
+    # Minutes past midnight of an HH:MM start time, NaN where there isn't one
+    parts = startTimes.astype(str).str.extract(r'^(\d{1,2}):(\d{2})')
+    return (pd.to_numeric(parts[0]) * 60 + pd.to_numeric(parts[1])).to_numpy(dtype=float)
+
+class DuplicateIndex:
+
+    def __init__(self, records_df, countTolerance=0.25, timeTolerance=60):
+        # records_df holds BirdTrack format records (Scientific name, Date, Grid reference,
+        # Observer name, Count and Start time).  Counts match if they differ by no more than
+        # countTolerance of the larger count and start times if they are no more than
+        # timeTolerance minutes apart.  A missing or non-numeric count or start time matches
+        # anything
+        self.countTolerance = countTolerance
+        self.timeTolerance = timeTolerance
+        keys = blockingKeys(records_df)
+        indexed = keys.notna().to_numpy()
+        self.index_df = pd.DataFrame({'key'     : keys.to_numpy()[indexed],
+                                      'count'   : numericCounts(records_df['Count'])[indexed],
+                                      'minutes' : startMinutes(records_df['Start time'])[indexed]})
+
+    def __len__(self):
+        return len(self.index_df)
+
+    def probe(self, records_df):
+        # Boolean array marking the records that are likely duplicates of indexed records
+        keys = blockingKeys(records_df)
+        probe_df = pd.DataFrame({'row'     : np.arange(len(records_df)),
+                                 'key'     : keys.to_numpy(),
+                                 'count'   : numericCounts(records_df['Count']),
+                                 'minutes' : startMinutes(records_df['Start time'])})
+        probe_df = probe_df[keys.notna().to_numpy()]
+        pairs = probe_df.merge(self.index_df, on='key', suffixes=('', '_indexed'))
+        largest = np.fmax(pairs['count'], pairs['count_indexed'])
+        countsMatch = (pairs['count'].isna() | pairs['count_indexed'].isna() |
+                       ((pairs['count'] - pairs['count_indexed']).abs() <= self.countTolerance * largest))
+        timesMatch = (pairs['minutes'].isna() | pairs['minutes_indexed'].isna() |
+                      ((pairs['minutes'] - pairs['minutes_indexed']).abs() <= self.timeTolerance))
+        duplicate = np.zeros(len(records_df), dtype=bool)
+        duplicate[pairs.loc[countsMatch & timesMatch, 'row'].to_numpy()] = True
+        return duplicate
@@ -36,120 +36,101 @@
 # - The column containing the 1km Grid Reference
 # - The column containing the BirdTrack breeding code
 # - The total number of 1km squares for the area the records relate to (optional)
+# - Any decoded breeding statuses to report on the Breeding sheet in addition to
+#   possible, probable and confirmed e.g. Non-breeding (optional)
+# - Whether the Calendar sheet counts records by month or by ISO week (optional, default month)
+# - The number of rows to read at a time - the input is streamed in chunks of this size
+#   and only aggregates are held in memory (optional, default read the whole file at once)
+# - The output format - an Excel workbook written by openpyxl or in constant memory by
+#   xlsxwriter, or a folder of parquet or csv files with one file per sheet (optional)
+# - The file path of a snapshot of the aggregated records.  When it exists the input file
+#   only needs to contain records added since the snapshot was saved.  A snapshot built by an
+#   older version or with different species normalisation tables stops the script (optional)
 
 # TODO investigate why there are fewer 1km squares identified by Python than the QGIS Biological Reporting Tool
 
 import argparse
 import pandas as pd
 from datetime import date, datetime as dt
+import hashlib
+import itertools
+import openpyxl
 import pathlib
 import sys
 import time
 import re
-
-speciesToIgnore = ['Black Swan',
-                   'Domestic Greylag Goose',
-                   'Chiffchaff/Willow Warbler',
-                   'Common/Arctic Tern',
-                   'Common/Lesser Redpoll',
-                   'Domestic Greylag Goose',
-                   'Domestic Mallard',
-                   "Harris's Hawk",
-                   'Hybrid duck',
-                   'Hybrid goose',
-                   'Indian Peafowl',
-                   'Long-eared/Short-eared Owl',
-                   'Muscovy Duck',
-                   'Ruddy Shelduck',
-                   'South African Shelduck',
-                   'Swan Goose']
-# Will also ignore Unidentified anything!
-
-speciesToChange = {
-    'Black Guillemot (arcticus)'            :   'Black Guillemot',
-    'Black-tailed Godwit (islandica)'       :	'Black-tailed Godwit',
-    'Blackbird (merula)'                    :	'Blackbird',
-    'Blue Tit (obscurus)'                   :	'Blue Tit',
-    'Brent Goose (Light-bellied - hrota)'   :	'Brent Goose',
-    'Bullfinch (pyrrhula)'                  :	'Bullfinch',
-    'Buzzard (buteo)'                       :	'Buzzard',
-    'Carrion Crow (corone)'                 :	'Carrion Crow',
-    'Chaffinch (coelebs)'                   :	'Chaffinch',
-    'Chaffinch (gengleri)'                  :	'Chaffinch',
-    'Coal Tit Continental – ater'           :   'Coal Tit',
-    'Common Crossbill (curvirostra)'        :	'Common Crossbill',
-    'Common Gull (canus)'                   :	'Common Gull',
-    'Common/Lesser Redpoll'                 :   'Lesser Redpoll',
-    'Coot (atra)'                           :	'Coot',
-    'Cormorant (Continental - sinensis)'    :	'Cormorant',
-    'Cormorant (Nominate - carbo)'          :	'Cormorant',
-    'Cuckoo (canorus)'                      :	'Cuckoo',
-    'Dunlin (alpina)'                       :	'Dunlin',
-    'Dunnock (occidentalis)'                :	'Dunnock',
-    'Eider (mollissima)'                    :	'Eider',
-    'Garden Warbler (borin)'                :	'Garden Warbler',
-    'Goldeneye (clangula)'                  :	'Goldeneye',
-    'Goldfinch (britannica)'                :	'Goldfinch',
-    'Goosander (merganser)'                 :	'Goosander',
-    'Great Spotted Woodpecker (anglicus)'   :	'Great Spotted Woodpecker',
-    'Great Tit (newtoni)'                   :	'Great Tit',
-    'Grey Heron (cinerea)'                  :	'Grey Heron',
-    'Greylag Goose (anser)'                 :	'Greylag Goose',
-    'House Sparrow (domesticus)'            :	'House Sparrow',
-    'Jackdaw (spermologus)'                 :	'Jackdaw',
-    'Kestrel (tinnunculus)'                 :	'Kestrel',
-    'Lesser Black-backed Gull (graellsii)'  :	'Lesser Black-backed Gull',
-    'Linnet (cannabina)'                    :	'Linnet',
-    'Long-tailed Tit (rosaceus)'            :	'Long-tailed Tit',
-    'Magpie (pica)'                         :	'Magpie',
-    'Mallard (platyrhynchos)'               :	'Mallard',
-    'Moorhen (chloropus)'                   :	'Moorhen',
-    'Nuthatch (caesia)'                     :	'Nuthatch',
-    'Oystercatcher (ostralegus)'            :	'Oystercatcher',
-    'Peregrine (peregrinus)'                :	'Peregrine',
-    'Red Grouse (scotica)'                  :	'Red Grouse',
-    'Robin (melophilus)'                    :	'Robin',
-    'Rock Dove'                             :	'Feral Pigeon',
-    'Rook (frugilegus)'                     :	'Rook',
-    'Sand Martin (riparia)'                 :	'Sand Martin',
-    'Shag (aristotelis)'                    :	'Shag',
-    'Snipe (gallinago)'                     :	'Snipe',
-    'Starling (vulgaris)'                   :	'Starling',
-    'Swallow (rustica)'                     :	'Swallow',
-    'Swift (apus)'                          :	'Swift',
-    'Treecreeper (britannica)'              :	'Treecreeper',
-    'Willow Warbler (trochilus)'            :	'Willow Warbler',
-    'Woodpigeon (palumbus)'                 :	'Woodpigeon',
-    'Yellow-legged Gull (michahellis)'      :	'Yellow-legged Gull'}
-
-# AKA Summer Visitors
-summerVisitors = ['Arctic Tern', 'Blackcap', 'Blackcap (atricapilla)', 'Chiffchaff',
-                  'Common Sandpiper', 'Common Tern', 'Cuckoo', 'Dotterel', 'Gannet',
-                  'Garden Warbler', 'Garganey', 'Grasshopper Warbler', 'House Martin',
-                  'Lesser Whitethroat', 'Little Ringed Plover', 'Manx Shearwater',
-                  'Marsh Harrier', 'Osprey', 'Pied Flycatcher', 'Quail', 'Redstart',
-                  'Reed Warbler', 'Ring Ouzel', 'Sand Martin', 'Sandwich Tern',
-                  'Sedge Warbler', 'Spotted Crake', 'Spotted Flycatcher', 'Swallow',
-                  'Swift', 'Tree Pipit', 'Wheatear', 'Wheatear (Greenland - leucorhoa)',
-                  'Whimbrel', 'Whinchat', 'White Wagtail', 'Whitethroat', 'Willow Warbler',
-                  'Willow Warbler (trochilus)', 'Wood Sandpiper', 'Wood Warbler',
-                  'Yellow Wagtail', 'Yellow Wagtail (British - flavissima)']
-
-winterVisitors = ['Barnacle Goose', "Bewick's Swan", 'Brambling', 'Brent Goose',
-                  'Brent Goose (Light-bellied - hrota)', 'Chiffchaff (Siberian - tristis)',
-                  'Fieldfare', 'Glaucous Gull  ', 'Goldeneye', 'Great Grey Shrike',
-                  'Greenshank', 'Iceland Gull', 'Jack Snipe', 'Long-tailed Duck',
-                  'Pink-footed Goose', 'Pintail', 'Redwing', 'Slavonian Grebe', 'Smew',
-                  'Snow Bunting', 'Taiga Bean Goose', 'Taiga/Tundra Bean Goose',
-                  'Tundra Bean Goose', 'Turnstone', 'Waxwing', 'White Wagtail (alba)',
-                  'White-fronted Goose', 'White-fronted Goose (European - albifrons)',
-                  'White-fronted Goose (Greenland - flavirostris)', 'Whooper Swan']
-
-def transformSpecies(species):
-    if species in speciesToChange:
-        return speciesToChange[species]
+from speciesTaxonomy import SpeciesTaxonomy
+from summaryAggregates import SummaryAggregates
+from stageTimer import StageTimer
+from summaryWriter import writeSheets, outputFormats
+
+# Decoded breeding statuses reported on the Breeding sheet and the label used in
+# their column headings.  Further statuses can be reported with --extra_breeding_statuses
+breedingCategories = {'Possible breeder'   : 'Possible',
+                      'Probable breeding'  : 'Probable',
+                      'Confirmed breeding' : 'Confirmed'}
+
+def fileDigest(filePath):
+    digest = hashlib.sha256()
+    with open(filePath, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def readRecords(inputFilePath, chunksize):
+    # Read only the columns the summary needs, either as a single frame or as a stream
+    # of chunks of at most chunksize rows.  Dates are converted a whole column at a time
+    # rather than cell by cell
+    usecols = list(columns.values())
+    if pathlib.Path(inputFilePath).suffix == '.csv':
+        print('Processing a csv file {}'.format(inputFilePath))
+        if chunksize:
+            chunks = pd.read_csv(inputFilePath, usecols=usecols, chunksize=chunksize)
+        else:
+            chunks = [pd.read_csv(inputFilePath, usecols=usecols)]
+    elif pathlib.Path(inputFilePath).suffix == '.xlsx':
+        print('Processing sheet {} in Excel file {}'.format(args.sheet_name, inputFilePath))
+        if chunksize:
+            chunks = readExcelChunks(inputFilePath, args.sheet_name, usecols, chunksize)
+        else:
+            chunks = [pd.read_excel(inputFilePath, sheet_name=args.sheet_name, usecols=usecols)]
     else:
-        return species
+        sys.exit('Invalid file type {}'.format(inputFilePath))
+    for chunk in chunks:
+        chunk[args.date_column] = parseDates(chunk[args.date_column])
+        yield chunk
+
+def parseDates(values):
+    # Dates only take a few hundred distinct values a year so parse each distinct value
+    # once (day first, as BirdTrack exports them) and broadcast the result back
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    codes, uniques = pd.factorize(values)
+    parsed = pd.DatetimeIndex(pd.to_datetime(pd.Series(uniques, dtype=object), format='mixed', dayfirst=True))
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=values.index)
+
+def readExcelChunks(inputFilePath, sheetName, usecols, chunksize):
+    # Stream the rows of an Excel sheet using openpyxl's read only mode
+    workbook = openpyxl.load_workbook(inputFilePath, read_only=True, data_only=True)
+    rows = workbook[sheetName].iter_rows(values_only=True)
+    header = next(rows)
+    while True:
+        block = list(itertools.islice(rows, chunksize))
+        if len(block) == 0:
+            break
+        yield pd.DataFrame(block, columns=header)[usecols].dropna(how='all')
+    workbook.close()
+
+def normaliseSpecies(df):
+    # Remove non-species and change defined sub-species to main species - drop all rows
+    # for species begining Unidentified and the species to ignore (generally unspecific
+    # ones) and transform all rows for sub-species that should be consolidated with the
+    # main species.  The decisions are made once per distinct species name and the
+    # Species column comes back as a categorical so later grouping is cheap
+    keep, species = taxonomy.normaliseCategorical(df['Species'])
+    df = df[keep].copy()
+    df['Species'] = species[keep]
+    return df
 
 start_time = time.time()
 
@@ -167,215 +148,92 @@ parser.add_argument('-c', '--count_column', type=str, required=False, default='N
 parser.add_argument('-g', '--gridRef_column', type=str, required=False, default='1km Grid Ref', help='column containing the 1km grid ref')
 parser.add_argument('-b', '--breedingCode_column', type=str, required=False, default='Decoded Breeding Status', help='column containing the decoded breeding code')
 parser.add_argument('-t', '--total_squares', type=str, required=True, help='total number of 1km squares for the area the records relate to')
-parser.add_argument('-f', '--output_file_path', type=str, required=False, default='speciesSummary.xlsx', help='filepath for output Excel file')
+parser.add_argument('-w', '--calendar_period', type=str, required=False, default='month', choices=['month', 'week'], help='granularity of the Calendar sheet - calendar month or ISO week')
+parser.add_argument('-e', '--extra_breeding_statuses', type=str, nargs='*', required=False, default=[], help="additional decoded breeding statuses to report on the Breeding sheet e.g. 'Non-breeding' 'Unknown'")
+parser.add_argument('-k', '--chunksize', type=int, required=False, default=None, help='stream the input in chunks of this many rows to bound memory use')
+parser.add_argument('-a', '--state_file_path', type=str, required=False, default=None, help='snapshot of the aggregated records - if it exists the input file is treated as new records to be merged into it, and the merged snapshot is saved back')
+parser.add_argument('--timings_file_path', type=str, required=False, default=None, help='write the time and memory used by each stage of the run to this JSON file')
+parser.add_argument('--trace_memory', action='store_true', help='record the peak memory allocated within each stage in the timings file (slower)')
+parser.add_argument('-x', '--taxonomy_cache_file_path', type=str, required=False, default=None, help='cache file for the compiled species taxonomy')
+parser.add_argument('-f', '--output_file_path', type=str, required=False, default='speciesSummary.xlsx', help='filepath for output Excel file, or the folder for parquet or csv output')
+parser.add_argument('-q', '--output_format', type=str, required=False, default='excel', choices=outputFormats, help='excel (openpyxl), excel-streaming (constant memory xlsxwriter) or a folder of parquet or csv files, one per sheet')
 
 args = parser.parse_args()
 config = vars(args)
 
-if pathlib.Path(args.input_file_path).suffix == '.csv':
-    print('Processing a csv file {}'.format(args.file_path))
-    df = pd.read_csv(args.input_file_path, converters= {args.date_column: pd.to_datetime})
-elif pathlib.Path(args.input_file_path).suffix == '.xlsx':
-    print('Processing sheet {} in Excel file {}'.format(args.sheet_name, args.input_file_path))
-    df = pd.read_excel(args.input_file_path, converters= {args.date_column: pd.to_datetime}, sheet_name=args.sheet_name)
-else:
-    sys.exit('Invalid file type {}'.format(args.input_file_path))
-
-# Remove non-species and change defined sub-species to main species
-# Firstly drop all rows for species begining Unidentified
-print('Removing Unidentified Species')
-df = df.drop(df[df['Species'].str.startswith('Unidentified')].index)
-
-# Then drop the species to ignore - generally unspecific ones
-print('Removing unspecific species')
-df = df[~(df['Species'].isin(speciesToIgnore))]
-
-#Finally transform all rows for sub-species that should be consolidated with
-# the main species
-print('Fixing incorrect subspecies')
-df['Species'] = df['Species'].map(transformSpecies)
-
-# - Total number of records
-totalRecords = len(df)
-summary = {'Summary': ['Input file contains {} records'.format(totalRecords)]}
-
-# - Total number of species observed
-totalSpecies = df[args.speciesName_column].nunique()
-summary['Summary'].append('{} unique species names (NB sub species will be counted as different species and includes species beginning unidentified)'.format(totalSpecies))
-
-# - Total number of discrete place names where observations were made
-totalPlaces = df[args.place_column].nunique()
-summary['Summary'].append('{} unique place names'.format(totalPlaces))
-
-# - Total number of observers
-totalObservers = df[args.observer_column].nunique()
-summary['Summary'].append('{} unique observers'.format(totalObservers))
-
-# - Total number of days in the year when species observations were made
-totalDays = df[args.date_column].nunique()
-summary['Summary'].append('{} unique days on which observations were made'.format(totalDays))
-
-# - Total count for all species
-totalCount = df[args.count_column].sum()
-summary['Summary'].append('{} individual birds (At least)'.format(totalCount))
-
-# - Total number of 1km squares where observations were logged
-totalSquares = df[args.gridRef_column].nunique()
-summary['Summary'].append('In {} unique 1km squares'.format(totalSquares))
-
-# - Overall % coverage of 1km squares
-pcentCoverage = totalSquares/int(args.total_squares) * 100
-summary['Summary'].append('Overall {}% of 1km squares had observations recorded in them'.format(pcentCoverage))
-
-summary_df = pd.DataFrame(summary)
-
-# sort the input file by Species and Date
-df.sort_values(by=[args.bouOrder_column, args.date_column], inplace=True)
-print('Input file sorted')
-
-# get the list of species in the report
-speciesList = df.Species.unique()
-
-# create the output dataframe
-species_df = pd.DataFrame(columns=['Species', 'Records', 'Places', 'Observers', 'Days', 'Total count', '1km squares', '% 1km Squares'])
-calendar_df = pd.DataFrame(columns=['Species', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                                    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
-breeding_df = pd.DataFrame(columns=['Species', 'Possible Records', 'Possible Counts', 'Possible Squares', 'Possible Squares %', 'Earliest Possible', 'Latest Possible',
-                                    'Probable Records', 'Probable Counts', 'Probable Squares', 'Probable Squares %', 'Earliest Probable', 'Latest Probable',
-                                    'Confirmed Records', 'Confirmed Counts', 'Confirmed Squares', 'Confirmed Squares %', 'Earliest Confirmed', 'Latest Confirmed'])
-breeding_df['Earliest Possible'] = pd.to_datetime(breeding_df['Earliest Possible'])
-breeding_df['Earliest Probable'] = pd.to_datetime(breeding_df['Earliest Probable'])
-breeding_df['Earliest Confirmed'] = pd.to_datetime(breeding_df['Earliest Confirmed'])
-breeding_df['Latest Possible'] = pd.to_datetime(breeding_df['Latest Possible'])
-breeding_df['Latest Probable'] = pd.to_datetime(breeding_df['Latest Probable'])
-breeding_df['Latest Confirmed'] = pd.to_datetime(breeding_df['Latest Confirmed'])
-
-summerVistors_df = pd.DataFrame(columns=['Species', 'Earliest', 'Latest'])
-winterVisitors_df = pd.DataFrame(columns=['Species', 'Earliest', 'Latest'])
-breederIndex = 0
-summerVisitorIndex = 0
-winterVisitorIndex = 0
-
-for index in range(len(speciesList)):
-    print('Processing {}'.format(speciesList[index]))
-    # extract the records for that Species
-    species_extract_df = df[df[args.speciesName_column] == speciesList[index]]
-    species_df.loc[index] = {'Species'      : speciesList[index],
-                             'Records'      : len(species_extract_df),
-                             'Places'       : species_extract_df[args.place_column].nunique(),
-                             'Observers'    : species_extract_df[args.observer_column].nunique(),
-                             'Days'         : species_extract_df[args.date_column].nunique(),
-                             'Total count'  : species_extract_df[args.count_column].sum(),
-                             '1km squares'  : species_extract_df[args.gridRef_column].nunique(),
-                             '% 1km Squares': '{:.2f}'.format(species_extract_df[args.gridRef_column].nunique()/totalSquares*100)}
-    # create a dataframe that contains a count of records by month
-    monthcount_df = species_extract_df.groupby(species_extract_df[args.date_column].dt.month).count().rename_axis(['Month'])[args.date_column].reset_index(name='Count')
-    monthArray = []
-    for monthInt in range(1,13):
-        if monthcount_df.loc[monthcount_df.Month == monthInt].empty:
-            count = 0
-        else:
-            count = monthcount_df.loc[monthcount_df.Month == monthInt].Count.item()
-        monthArray.append(count)
-    calendar_df.loc[index] = {'Species': speciesList[index],
-                              'Jan'    : monthArray[0],
-                              'Feb'    : monthArray[1],
-                              'Mar'    : monthArray[2],
-                              'Apr'    : monthArray[3],
-                              'May'    : monthArray[4],
-                              'Jun'    : monthArray[5],
-                              'Jul'    : monthArray[6],
-                              'Aug'    : monthArray[7],
-                              'Sep'    : monthArray[8],
-                              'Oct'    : monthArray[9],
-                              'Nov'    : monthArray[10],
-                              'Dec'    : monthArray[11]}
-    breedingMatches = ['Possible breeder', 'Probable breeding', 'Confirmed breeding']
-    if any(x in species_extract_df[args.breedingCode_column].values.tolist() for x in breedingMatches):
-        print('Species has breeding data')
-        possibleRecords = possibleCounts = possibleSquares = possibleSquaresPcent = 0
-        earliestPossible = latestPossible = date.min
-        probableRecords = probableCounts = probableSquares = probableSquaresPcent= 0
-        earliestProbable = latestProbable = date.min
-        confirmedRecords = confirmedCounts = confirmedSquares = confirmnedSquaresPcent= 0
-        earliestConfirmed = latestConfirmed = date.min
-        breeding_df.loc[breederIndex] = {'Species': speciesList[index]}
-        if 'Possible breeder' in species_extract_df[args.breedingCode_column].values.tolist():
-            possibleBreeder_df = species_extract_df[species_extract_df[args.breedingCode_column] == 'Possible breeder']
-            possibleRecords = len(possibleBreeder_df)
-            possibleCounts = possibleBreeder_df[args.count_column].sum()
-            possibleSquares = possibleBreeder_df[args.gridRef_column].nunique()
-            possibleSquaresPcent = possibleBreeder_df[args.gridRef_column].nunique() / totalSquares * 100
-            earliestPossible = possibleBreeder_df[args.date_column].min()
-            latestPossible = possibleBreeder_df[args.date_column].max()
-        if 'Probable breeding' in species_extract_df[args.breedingCode_column].values.tolist():
-            probableBreeder_df = species_extract_df[species_extract_df[args.breedingCode_column] == 'Probable breeding']  
-            probableRecords = len(probableBreeder_df)
-            probableCounts = probableBreeder_df[args.count_column].sum()
-            probableSquares = probableBreeder_df[args.gridRef_column].nunique()
-            probableSquaresPcent = probableBreeder_df[args.gridRef_column].nunique() / totalSquares * 100
-            earliestProbable = probableBreeder_df[args.date_column].min()
-            latestProbable = probableBreeder_df[args.date_column].max()
-        if 'Confirmed breeding' in species_extract_df[args.breedingCode_column].values.tolist():
-            confirmedBreeder_df = species_extract_df[species_extract_df[args.breedingCode_column] == 'Confirmed breeding']  
-            confirmedRecords = len(confirmedBreeder_df)
-            confirmedCounts = confirmedBreeder_df[args.count_column].sum()
-            confirmedSquares = confirmedBreeder_df[args.gridRef_column].nunique()
-            confirmnedSquaresPcent = confirmedBreeder_df[args.gridRef_column].nunique() / totalSquares * 100
-            earliestConfirmed = confirmedBreeder_df[args.date_column].min()
-            latestConfirmed = confirmedBreeder_df[args.date_column].max()        
-        breeding_df.loc[breederIndex] = {'Species'              : speciesList[index],
-                                         'Possible Records'     : possibleRecords,
-                                         'Possible Counts'      : possibleCounts,
-                                         'Possible Squares'     : possibleSquares,
-                                         'Possible Squares %'   : possibleSquaresPcent,
-                                         'Earliest Possible'    : earliestPossible,
-                                         'Latest Possible'      : latestPossible,
-                                         'Probable Records'     : probableRecords,
-                                         'Probable Counts'      : probableCounts,
-                                         'Probable Squares'     : probableSquares,
-                                         'Probable Squares %'   : probableSquaresPcent,
-                                         'Earliest Probable'    : earliestProbable,
-                                         'Latest Probable'      : latestProbable,
-                                         'Confirmed Records'    : confirmedRecords,
-                                         'Confirmed Counts'     : confirmedCounts,
-                                         'Confirmed Squares'    : confirmedSquares,
-                                         'Confirmed Squares %'  : confirmnedSquaresPcent,
-                                         'Earliest Confirmed'   : earliestConfirmed,
-                                         'Latest Confirmed'     : latestConfirmed}
-        breederIndex += 1
-
-    # populate the summer visitors dataframe
-    if speciesList[index] in summerVisitors:
-        summerVistors_df.loc[summerVisitorIndex] = {'Species' : speciesList[index],
-                                                    'Earliest' : species_extract_df[args.date_column].min(),
-                                                    'Latest'   : species_extract_df[args.date_column].max()}
-        summerVisitorIndex += 1
-    if speciesList[index] in winterVisitors:
-        janToJun_df = species_extract_df[species_extract_df[args.date_column].dt.month < 7]
-        julToDec_df = species_extract_df[species_extract_df[args.date_column].dt.month > 6]
-        if len(julToDec_df) > 0:
-            earliestWinter = julToDec_df[args.date_column].min()
-        else:
-            earliestWinter = date.min
-        if len(janToJun_df) > 0:
-            latestWinter = janToJun_df[args.date_column].max()
-        else:
-            latestWinter = date.min
-        winterVisitors_df.loc[winterVisitorIndex] = {'Species' : speciesList[index],
-                                                    'Earliest' : earliestWinter,
-                                                    'Latest'   : latestWinter}
-        winterVisitorIndex += 1
-
-with pd.ExcelWriter(args.output_file_path, engine='openpyxl', 
-                    date_format='DD/MM/YYYY') as writer:
-    summary_df.to_excel(writer, sheet_name='Summary', index=False)
-    species_df.to_excel(writer, sheet_name='Species', index=False)
-    calendar_df.to_excel(writer, sheet_name='Calendar', index=False)
-    breeding_df.to_excel(writer, sheet_name='Breeding', index=False)
-    summerVistors_df.to_excel(writer, sheet_name='Summer Visitors', index=False)
-    winterVisitors_df.to_excel(writer, sheet_name='Winter Visitors', index=False)
+columns = {'species'  : args.speciesName_column,
+           'bouOrder' : args.bouOrder_column,
+           'place'    : args.place_column,
+           'observer' : args.observer_column,
+           'date'     : args.date_column,
+           'count'    : args.count_column,
+           'gridRef'  : args.gridRef_column,
+           'breeding' : args.breedingCode_column}
+
+timer = StageTimer(args.trace_memory)
+taxonomy = SpeciesTaxonomy.load(cacheFilePath=args.taxonomy_cache_file_path)
+
+# Start from the saved aggregates if there are any so that only the new records in the
+# input file need to be processed
+aggregates = None
+fingerprint = taxonomy.fingerprint
+if args.state_file_path and pathlib.Path(args.state_file_path).exists():
+    aggregates = SummaryAggregates.load(args.state_file_path, fingerprint)
+    if aggregates is None:
+        # the snapshot can't be added to, and summarising only the new records would replace it
+        # with a summary of part of the year
+        sys.exit('ERROR - {} was built with different species normalisation tables or an older version. '
+                 'Remove it and re-run with an input file containing all the records for the year'.format(args.state_file_path))
+    print('Loaded aggregates for {} records from {}'.format(aggregates.totalRecords, args.state_file_path))
+if aggregates is None:
+    aggregates = SummaryAggregates(columns)
+aggregates.columns = columns
+
+inputDigest = fileDigest(args.input_file_path) if args.state_file_path else None
+if inputDigest in aggregates.inputDigests:
+    sys.exit('{} has already been merged into {}'.format(args.input_file_path, args.state_file_path))
+
+# Fold the records into mergeable aggregates one chunk at a time.  Without a chunksize the
+# whole file is read as a single chunk
+chunks = readRecords(args.input_file_path, args.chunksize)
+while True:
+    with timer.stage('load'):
+        chunk = next(chunks, None)
+    if chunk is None:
+        break
+    with timer.stage('normalise'):
+        chunk = normaliseSpecies(chunk)
+    aggregates.fold(chunk, timer)
+    print('{} records processed'.format(aggregates.rowsSeen))
+
+if args.state_file_path:
+    aggregates.inputDigests.add(inputDigest)
+    aggregates.save(args.state_file_path, fingerprint)
+    print('Aggregates saved to {}'.format(args.state_file_path))
+
+with timer.stage('summary'):
+    summary_df = aggregates.summarySheet(args.total_squares)
+with timer.stage('per-species'):
+    species_df = aggregates.speciesSheet()
+with timer.stage('calendar'):
+    calendar_df = aggregates.calendarSheet(args.calendar_period)
+with timer.stage('breeding'):
+    breeding_df = aggregates.breedingSheet({**breedingCategories, **{status: status for status in args.extra_breeding_statuses}})
+with timer.stage('visitors'):
+    summerVistors_df = aggregates.summerVisitorsSheet(taxonomy.classes['summer visitor'])
+    winterVisitors_df = aggregates.winterVisitorsSheet(taxonomy.classes['winter visitor'])
+
+with timer.stage('excel write' if args.output_format.startswith('excel') else 'bundle write'):
+    writeSheets({'Summary'         : summary_df,
+                 'Species'         : species_df,
+                 'Calendar'        : calendar_df,
+                 'Breeding'        : breeding_df,
+                 'Summer Visitors' : summerVistors_df,
+                 'Winter Visitors' : winterVisitors_df}, args.output_file_path, args.output_format)
 
 runTime = time.time() - start_time
 convert = time.strftime('%H:%M:%S', time.gmtime(runTime))
-print('Execution took {}'.format(convert))
\ No newline at end of file
+print('Execution took {}'.format(convert))
+
+if args.timings_file_path:
+    timer.save(args.timings_file_path, records=aggregates.totalRecords, seconds=runTime, output_format=args.output_format)
\ No newline at end of file
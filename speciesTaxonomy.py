@@ -0,0 +1,239 @@
+# Species taxonomy shared by the scripts in this repository.
+#
+# The species tables used to normalise, filter and classify species are held here once:
+#
+# - species to ignore (along with anything beginning Unidentified)
+# - sub species and alternative names to change to the main species
+# - summer and winter visitors (speciesSummary.py)
+# - RSPB ARM residents and migrants (reformatRSPB.py)
+# - optionally the BirdTrack BOU order csv keyed on scientific name (mergeEBirdToBT.py)
+#
+# SpeciesTaxonomy loads them into hashed sets and indexes and gives each known species name
+# an integer id, so that scripts can apply them to whole columns at once rather than
+# scanning lists row by row.  The loaded taxonomy can be saved to a cache file which is
+# reused for as long as the tables and the BOU order csv are unchanged.
+
+import hashlib
+import json
+import pathlib
+import numpy as np
+import pandas as pd
+
+speciesToIgnore = ['Black Swan',
+                   'Domestic Greylag Goose',
+                   'Chiffchaff/Willow Warbler',
+                   'Common/Arctic Tern',
+                   'Common/Lesser Redpoll',
+                   'Domestic Greylag Goose',
+                   'Domestic Mallard',
+                   "Harris's Hawk",
+                   'Hybrid duck',
+                   'Hybrid goose',
+                   'Indian Peafowl',
+                   'Long-eared/Short-eared Owl',
+                   'Muscovy Duck',
+                   'Ruddy Shelduck',
+                   'South African Shelduck',
+                   'Swan Goose']
+# Will also ignore Unidentified anything!
+
+speciesToChange = {
+    'Black Guillemot (arcticus)'            :   'Black Guillemot',
+    'Black-tailed Godwit (islandica)'       :	'Black-tailed Godwit',
+    'Blackbird (merula)'                    :	'Blackbird',
+    'Blue Tit (obscurus)'                   :	'Blue Tit',
+    'Brent Goose (Light-bellied - hrota)'   :	'Brent Goose',
+    'Bullfinch (pyrrhula)'                  :	'Bullfinch',
+    'Buzzard (buteo)'                       :	'Buzzard',
+    'Carrion Crow (corone)'                 :	'Carrion Crow',
+    'Chaffinch (coelebs)'                   :	'Chaffinch',
+    'Chaffinch (gengleri)'                  :	'Chaffinch',
+    'Coal Tit Continental – ater'           :   'Coal Tit',
+    'Common Crossbill (curvirostra)'        :	'Common Crossbill',
+    'Common Gull (canus)'                   :	'Common Gull',
+    'Common/Lesser Redpoll'                 :   'Lesser Redpoll',
+    'Coot (atra)'                           :	'Coot',
+    'Cormorant (Continental - sinensis)'    :	'Cormorant',
+    'Cormorant (Nominate - carbo)'          :	'Cormorant',
+    'Cuckoo (canorus)'                      :	'Cuckoo',
+    'Dunlin (alpina)'                       :	'Dunlin',
+    'Dunnock (occidentalis)'                :	'Dunnock',
+    'Eider (mollissima)'                    :	'Eider',
+    'Garden Warbler (borin)'                :	'Garden Warbler',
+    'Goldeneye (clangula)'                  :	'Goldeneye',
+    'Goldfinch (britannica)'                :	'Goldfinch',
+    'Goosander (merganser)'                 :	'Goosander',
+    'Great Spotted Woodpecker (anglicus)'   :	'Great Spotted Woodpecker',
+    'Great Tit (newtoni)'                   :	'Great Tit',
+    'Grey Heron (cinerea)'                  :	'Grey Heron',
+    'Greylag Goose (anser)'                 :	'Greylag Goose',
+    'House Sparrow (domesticus)'            :	'House Sparrow',
+    'Jackdaw (spermologus)'                 :	'Jackdaw',
+    'Kestrel (tinnunculus)'                 :	'Kestrel',
+    'Lesser Black-backed Gull (graellsii)'  :	'Lesser Black-backed Gull',
+    'Linnet (cannabina)'                    :	'Linnet',
+    'Long-tailed Tit (rosaceus)'            :	'Long-tailed Tit',
+    'Magpie (pica)'                         :	'Magpie',
+    'Mallard (platyrhynchos)'               :	'Mallard',
+    'Moorhen (chloropus)'                   :	'Moorhen',
+    'Nuthatch (caesia)'                     :	'Nuthatch',
+    'Oystercatcher (ostralegus)'            :	'Oystercatcher',
+    'Peregrine (peregrinus)'                :	'Peregrine',
+    'Red Grouse (scotica)'                  :	'Red Grouse',
+    'Robin (melophilus)'                    :	'Robin',
+    'Rock Dove'                             :	'Feral Pigeon',
+    'Rook (frugilegus)'                     :	'Rook',
+    'Sand Martin (riparia)'                 :	'Sand Martin',
+    'Shag (aristotelis)'                    :	'Shag',
+    'Snipe (gallinago)'                     :	'Snipe',
+    'Starling (vulgaris)'                   :	'Starling',
+    'Swallow (rustica)'                     :	'Swallow',
+    'Swift (apus)'                          :	'Swift',
+    'Treecreeper (britannica)'              :	'Treecreeper',
+    'Willow Warbler (trochilus)'            :	'Willow Warbler',
+    'Woodpigeon (palumbus)'                 :	'Woodpigeon',
+    'Yellow-legged Gull (michahellis)'      :	'Yellow-legged Gull'}
+
+# AKA Summer Visitors
+summerVisitors = ['Arctic Tern', 'Blackcap', 'Blackcap (atricapilla)', 'Chiffchaff',
+                  'Common Sandpiper', 'Common Tern', 'Cuckoo', 'Dotterel', 'Gannet',
+                  'Garden Warbler', 'Garganey', 'Grasshopper Warbler', 'House Martin',
+                  'Lesser Whitethroat', 'Little Ringed Plover', 'Manx Shearwater',
+                  'Marsh Harrier', 'Osprey', 'Pied Flycatcher', 'Quail', 'Redstart',
+                  'Reed Warbler', 'Ring Ouzel', 'Sand Martin', 'Sandwich Tern',
+                  'Sedge Warbler', 'Spotted Crake', 'Spotted Flycatcher', 'Swallow',
+                  'Swift', 'Tree Pipit', 'Wheatear', 'Wheatear (Greenland - leucorhoa)',
+                  'Whimbrel', 'Whinchat', 'White Wagtail', 'Whitethroat', 'Willow Warbler',
+                  'Willow Warbler (trochilus)', 'Wood Sandpiper', 'Wood Warbler',
+                  'Yellow Wagtail', 'Yellow Wagtail (British - flavissima)']
+
+winterVisitors = ['Barnacle Goose', "Bewick's Swan", 'Brambling', 'Brent Goose',
+                  'Brent Goose (Light-bellied - hrota)', 'Chiffchaff (Siberian - tristis)',
+                  'Fieldfare', 'Glaucous Gull  ', 'Goldeneye', 'Great Grey Shrike',
+                  'Greenshank', 'Iceland Gull', 'Jack Snipe', 'Long-tailed Duck',
+                  'Pink-footed Goose', 'Pintail', 'Redwing', 'Slavonian Grebe', 'Smew',
+                  'Snow Bunting', 'Taiga Bean Goose', 'Taiga/Tundra Bean Goose',
+                  'Tundra Bean Goose', 'Turnstone', 'Waxwing', 'White Wagtail (alba)',
+                  'White-fronted Goose', 'White-fronted Goose (European - albifrons)',
+                  'White-fronted Goose (Greenland - flavirostris)', 'Whooper Swan']
+
+# RSPB ARM (Annual Reserve Monitoring) species - residents are dated 15th April and migrants
+# 1st June by reformatRSPB.py
+residents = ['Black Grouse', 'Black-headed Gull', 'Blackbird', 'Blue Tit', 'Bullfinch', 'Buzzard', 'Canada Goose', 'Carrion Crow',
+             'Chaffinch', 'Coal Tit', 'Collared Dove', 'Coot', 'Dipper', 'Dunnock', 'Gadwall', 'Goldcrest', 'Goldeneye',
+             'Goldfinch', 'Goosander', 'Great Crested Grebe', 'Great Spotted Woodpecker', 'Great Tit', 'Greenfinch', 'Greylag Goose',
+             'House Sparrow', 'Jackdaw', 'Jay', 'Kestrel', 'Kingfisher', 'Lapwing', 'Lesser Redpoll', 'Little Grebe', 'Long-tailed Tit',
+             'Magpie', 'Mallard', 'Meadow Pipit', 'Mistle Thrush', 'Moorhen', 'Mute Swan', 'Nuthatch', 'Oystercatcher', 'Peregrine',
+             'Pheasant', 'Pied Wagtail', 'Raven', 'Redshank', 'Reed Bunting', 'Robin', 'Shoveler', 'Siskin',
+             'Skylark', 'Snipe', 'Song Thrush', 'Sparrowhawk', 'Starling', 'Stonechat', 'Tawny Owl', 'Teal', 'Treecreeper',
+             'Tufted Duck', 'Water Rail', 'Wigeon', 'Woodcock', 'Woodpigeon', 'Wren']
+migrants = ['Blackcap', 'Chiffchaff', 'Common Sandpiper', 'Cuckoo', 'Garden Warbler', 'Grasshopper Warbler', 'Little Ringed Plover', 'Osprey',
+            'Pied Flycatcher', 'Redstart', 'Sand Martin', 'Sedge Warbler', 'Spotted Crake', 'Spotted Flycatcher', 'Swallow', 'Tree Pipit', 'Whitethroat',
+             'Willow Warbler', 'Wood Warbler']
+
+class SpeciesTaxonomy:
+
+    def __init__(self, bouOrder_df=None):
+        self.ignore = frozenset(speciesToIgnore)
+        self.change = dict(speciesToChange)
+        self.classes = {'summer visitor' : frozenset(summerVisitors),
+                        'winter visitor' : frozenset(winterVisitors),
+                        'resident'       : frozenset(residents),
+                        'migrant'        : frozenset(migrants)}
+
+        # Integer ids for every species name the tables know about
+        names = set(self.ignore) | set(self.change) | set(self.change.values())
+        for classification in self.classes.values():
+            names |= classification
+        self.speciesNames = pd.Index(sorted(names))
+
+        # BOU order keyed on scientific name - where a name appears more than once the
+        # first entry is used
+        if bouOrder_df is not None:
+            bouOrder_df = bouOrder_df.drop_duplicates(subset='LATIN_NAME')
+            self.bouNames = pd.Index(bouOrder_df['LATIN_NAME'])
+            self.bouOrders = bouOrder_df['BOU_ORDER'].to_numpy(dtype=object)
+        else:
+            self.bouNames = pd.Index([])
+            self.bouOrders = np.array([], dtype=object)
+
+        self.fingerprint = normalisationFingerprint()
+
+    @classmethod
+    def load(cls, bouOrderFilePath=None, cacheFilePath=None):
+        # Load the taxonomy, reusing the cache file if it was built from the same tables
+        # and BOU order csv
+        sourceKey = sourceFingerprint(bouOrderFilePath)
+        if cacheFilePath and pathlib.Path(cacheFilePath).exists():
+            taxonomy = pd.read_pickle(cacheFilePath)
+            if getattr(taxonomy, 'sourceKey', None) == sourceKey:
+                return taxonomy
+        bouOrder_df = pd.read_csv(bouOrderFilePath) if bouOrderFilePath else None
+        taxonomy = cls(bouOrder_df)
+        taxonomy.sourceKey = sourceKey
+        if cacheFilePath:
+            pd.to_pickle(taxonomy, cacheFilePath)
+        return taxonomy
+
+    def isUnidentified(self, species):
+        return species.str.startswith('Unidentified', na=False)
+
+    def isIgnored(self, species):
+        # Unidentified anything and the unspecific species in speciesToIgnore
+        return self.isUnidentified(species) | species.isin(self.ignore)
+
+    def normalise(self, species):
+        # Change sub species and alternative names to the main species
+        return species.map(self.change).fillna(species)
+
+    def normaliseCategorical(self, species):
+        # Normalise a whole column of species names, deciding whether to ignore or rename
+        # each distinct name once and broadcasting the decisions back to the rows through
+        # the codes of a Categorical.  Returns a boolean Series of the rows to keep and the
+        # normalised names as a categorical Series (ignored rows are missing)
+        categorical = pd.Categorical(species)
+        names = categorical.categories.to_series()
+        ignored = self.isIgnored(names).to_numpy()
+        renamed = self.normalise(names).to_numpy()
+
+        # map each original category onto its normalised category, or -1 if ignored
+        categories = pd.Index(pd.unique(renamed[~ignored]))
+        categoryMap = np.where(ignored, -1, categories.get_indexer(renamed))
+
+        codes = categorical.codes
+        newCodes = np.where(codes >= 0, categoryMap[codes], -1)
+        keep = ~np.append(ignored, False)[codes]
+        normalised = pd.Categorical.from_codes(newCodes, categories=categories)
+        return pd.Series(keep, index=species.index), pd.Series(normalised, index=species.index, name=species.name)
+
+    def isClass(self, species, classification):
+        return species.isin(self.classes[classification])
+
+    def speciesId(self, species):
+        # Integer id of each species name, -1 for names the tables do not know
+        return pd.Series(self.speciesNames.get_indexer(species), index=species.index)
+
+    def bouOrderFor(self, scientificNames):
+        # BOU order for each scientific name, None where it is not in the BOU order csv
+        positions = self.bouNames.get_indexer(scientificNames)
+        return pd.Series(np.append(self.bouOrders, None)[positions], index=scientificNames.index)
+
+def normalisationFingerprint():
+    # Hash of the tables used to normalise species - data aggregated with different
+    # tables would be summarised differently
+    tables = {'unidentified' : 'Unidentified',
+              'ignore'       : sorted(speciesToIgnore),
+              'change'       : sorted(speciesToChange.items())}
+    return hashlib.sha256(json.dumps(tables).encode('utf-8')).hexdigest()
+
+def sourceFingerprint(bouOrderFilePath):
+    # Hash of every table and the BOU order csv, used to validate the cache file
+    digest = hashlib.sha256(json.dumps({'ignore'    : sorted(speciesToIgnore),
+                                        'change'    : sorted(speciesToChange.items()),
+                                        'summer'    : sorted(summerVisitors),
+                                        'winter'    : sorted(winterVisitors),
+                                        'residents' : sorted(residents),
+                                        'migrants'  : sorted(migrants)}).encode('utf-8'))
+    if bouOrderFilePath:
+        digest.update(pathlib.Path(bouOrderFilePath).read_bytes())
+    return digest.hexdigest()
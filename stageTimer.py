@@ -0,0 +1,60 @@
+# Accumulates the elapsed time and memory use of the named stages of a script run so that
+# benchmarkSpeciesSummary.py (and anyone else) can see where the time goes.
+#
+# Time is always recorded.  The process peak resident set size is recorded at the end of
+# each stage and, if traceMemory is set, tracemalloc is used to record the peak memory
+# allocated within each stage (this slows the run down so is off by default).
+
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+def peakRssMB():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+    return round(peak / 1024, 1)
+
+class StageTimer:
+
+    def __init__(self, traceMemory=False):
+        self.traceMemory = traceMemory
+        self.stages = {}
+        if traceMemory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += elapsed
+            stage['calls'] += 1
+            stage['peak_rss_mb'] = peakRssMB()
+            if self.traceMemory:
+                peakMB = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+                stage['peak_traced_mb'] = max(stage.get('peak_traced_mb', 0), peakMB)
+
+    def report(self):
+        return {'stages'      : self.stages,
+                'peak_rss_mb' : peakRssMB()}
+
+    def save(self, filePath, **extra):
+        with open(filePath, 'w') as file:
+            json.dump({**extra, **self.report()}, file, indent=2, default=str)
+
+# Used when no timings are wanted
+class NullTimer:
+
+    @contextmanager
+    def stage(self, name):
+        yield
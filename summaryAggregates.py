@@ -0,0 +1,320 @@
+# Mergeable aggregate state for speciesSummary.py
+#
+# Each chunk of (normalised) records is folded into partial aggregates that can be
+# combined with the aggregates of any other chunk:
+#
+# - record counts and count totals are summed
+# - earliest/latest dates take the min/max
+# - month and ISO week record counts are added together
+# - distinct places, observers, days and 1km squares are held as de-duplicated
+#   (species, value) pairs so distinct counts stay exact however the input is split
+# - the order in which species are reported is held as the lowest (BOU order, date, row)
+#   seen for each species, which reproduces sorting the whole input by BOU order and date
+#
+# The sheets of the summary workbook are then rendered from the merged state, so memory
+# is bounded by the size of the aggregates rather than by the size of the input file.
+#
+# The state can be saved to and reloaded from a snapshot file so that records arriving
+# later in the year only need to be folded into it rather than reprocessing every record.
+
+from datetime import date
+import numpy as np
+import pandas as pd
+from stageTimer import NullTimer
+
+# Bump when the layout of the aggregates changes so that older snapshots are not loaded
+stateVersion = 1
+
+monthNames = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+              'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Sheet names for the distinct values held per species and the column key they come from
+distinctColumns = {'Places'      : 'place',
+                   'Observers'   : 'observer',
+                   'Days'        : 'date',
+                   '1km squares' : 'gridRef'}
+
+def periodMatrix(speciesCodes, speciesNames, periodNumbers, periods):
+    # Count records per species and period (1 based month or week number) in one bincount
+    # over integer species codes.  Records without a species or a date are not counted
+    valid = (speciesCodes >= 0) & periodNumbers.notna().to_numpy()
+    cells = speciesCodes[valid] * periods + periodNumbers[valid].to_numpy(dtype='int64') - 1
+    matrix = np.bincount(cells, minlength=len(speciesNames) * periods).reshape(len(speciesNames), periods)
+    return pd.DataFrame(matrix, index=pd.Index(np.asarray(speciesNames), dtype=object), columns=range(1, periods + 1))
+
+def plainIndex(frame):
+    # Chunks are normalised into categoricals with different categories, so hold species
+    # in the aggregates as plain labels that can be merged across chunks
+    if isinstance(frame.index, pd.MultiIndex):
+        frame.index = pd.MultiIndex.from_arrays([frame.index.get_level_values(level).astype(object)
+                                                 for level in range(frame.index.nlevels)], names=frame.index.names)
+    else:
+        frame.index = frame.index.astype(object)
+    return frame
+
+class SummaryAggregates:
+
+    def __init__(self, columns):
+        # columns maps the keys species, bouOrder, place, observer, date, count,
+        # gridRef and breeding onto the column names used in the input file
+        self.columns = columns
+        self.totalRecords = 0
+        self.totalCount = 0
+        self.rowsSeen = 0
+        # digests of the input files already folded in, so a file is not counted twice
+        self.inputDigests = set()
+        self.first = pd.DataFrame(columns=['Species', 'BOU order', 'Date', 'Row'])
+        self.stats = pd.DataFrame(columns=['Records', 'Total count', 'Earliest', 'Latest',
+                                           'Earliest Jul-Dec', 'Latest Jan-Jun'])
+        self.distinct = {name: pd.DataFrame(columns=['Species', 'Value']) for name in distinctColumns}
+        self.months = pd.DataFrame(columns=range(1, 13), dtype='int64')
+        self.weeks = pd.DataFrame(columns=range(1, 54), dtype='int64')
+        self.breeding = pd.DataFrame(columns=['Records', 'Counts', 'Earliest', 'Latest'],
+                                     index=pd.MultiIndex.from_tuples([], names=['Species', 'Status']))
+        self.breedingSquares = pd.DataFrame(columns=['Species', 'Status', 'Value'])
+
+    def fold(self, df, timer=NullTimer()):
+        # Fold a chunk of records into the aggregates
+        partial = self.fromRecords(df, self.columns, self.rowsSeen, timer)
+        with timer.stage('merge'):
+            self.merge(partial)
+
+    @classmethod
+    def fromRecords(cls, df, columns, rowOffset=0, timer=NullTimer()):
+        # Build the partial aggregates for a single chunk of records.  The work is split
+        # into the stages reported by benchmarkSpeciesSummary.py
+        aggregates = cls(columns)
+        species = df[columns['species']]
+        dates = df[columns['date']]
+        months = dates.dt.month
+
+        with timer.stage('summary'):
+            aggregates.totalRecords = len(df)
+            aggregates.totalCount = df[columns['count']].sum()
+            aggregates.rowsSeen = len(df)
+            for name, key in distinctColumns.items():
+                pairs_df = pd.DataFrame({'Species': species.to_numpy(), 'Value': df[columns[key]].to_numpy()})
+                aggregates.distinct[name] = pairs_df.dropna().drop_duplicates()
+
+        with timer.stage('per-species'):
+            first_df = pd.DataFrame({'Species'   : species.to_numpy(),
+                                     'BOU order' : df[columns['bouOrder']].to_numpy(),
+                                     'Date'      : dates.to_numpy(),
+                                     'Row'       : np.arange(rowOffset, rowOffset + len(df))})
+            aggregates.first = cls._firstBySpecies(first_df)
+            grouped = df.groupby(species, sort=False, observed=True)
+            stats_df = pd.DataFrame({'Records'     : grouped.size(),
+                                     'Total count' : grouped[columns['count']].sum(),
+                                     'Earliest'    : grouped[columns['date']].min(),
+                                     'Latest'      : grouped[columns['date']].max()})
+
+        with timer.stage('visitors'):
+            stats_df['Earliest Jul-Dec'] = dates.where(months > 6).groupby(species, sort=False, observed=True).min()
+            stats_df['Latest Jan-Jun'] = dates.where(months < 7).groupby(species, sort=False, observed=True).max()
+            aggregates.stats = plainIndex(stats_df.rename_axis(None))
+
+        with timer.stage('calendar'):
+            speciesCodes, speciesNames = pd.factorize(species)
+            aggregates.months = periodMatrix(speciesCodes, speciesNames, months, 12)
+            aggregates.weeks = periodMatrix(speciesCodes, speciesNames, dates.dt.isocalendar().week, 53)
+
+        with timer.stage('breeding'):
+            breeders_df = df[df[columns['breeding']].notna()]
+            breedingGroups = breeders_df.groupby([columns['species'], columns['breeding']], sort=False, observed=True)
+            aggregates.breeding = plainIndex(pd.DataFrame({'Records'  : breedingGroups.size(),
+                                                'Counts'   : breedingGroups[columns['count']].sum(),
+                                                'Earliest' : breedingGroups[columns['date']].min(),
+                                                'Latest'   : breedingGroups[columns['date']].max()}).rename_axis(['Species', 'Status']))
+            squares_df = pd.DataFrame({'Species' : breeders_df[columns['species']].to_numpy(),
+                                       'Status'  : breeders_df[columns['breeding']].to_numpy(),
+                                       'Value'   : breeders_df[columns['gridRef']].to_numpy()})
+            aggregates.breedingSquares = squares_df.dropna().drop_duplicates()
+        return aggregates
+
+    @staticmethod
+    def _firstBySpecies(first_df):
+        # Keep the lowest (BOU order, date, row) for each species - missing BOU orders and
+        # dates sort last, as they do when the whole input is sorted
+        first_df = first_df.sort_values(by=['BOU order', 'Date', 'Row'], na_position='last', kind='mergesort')
+        return first_df.drop_duplicates(subset='Species').dropna(subset=['Species'])
+
+    @staticmethod
+    def _concat(frames):
+        # Concatenate partial aggregates, skipping empty ones so column dtypes are preserved
+        frames = [frame for frame in frames if len(frame) > 0]
+        if len(frames) == 0:
+            return None
+        return pd.concat(frames)
+
+    def merge(self, other):
+        # Combine another set of aggregates into this one
+        self.totalRecords += other.totalRecords
+        self.totalCount += other.totalCount
+        self.rowsSeen += other.rowsSeen
+        self.inputDigests |= other.inputDigests
+
+        first_df = self._concat([self.first, other.first])
+        if first_df is not None:
+            self.first = self._firstBySpecies(first_df)
+
+        stats_df = self._concat([self.stats, other.stats])
+        if stats_df is not None:
+            self.stats = stats_df.groupby(level=0, sort=False).agg({'Records'          : 'sum',
+                                                                    'Total count'      : 'sum',
+                                                                    'Earliest'         : 'min',
+                                                                    'Latest'           : 'max',
+                                                                    'Earliest Jul-Dec' : 'min',
+                                                                    'Latest Jan-Jun'   : 'max'})
+
+        for name in distinctColumns:
+            pairs_df = self._concat([self.distinct[name], other.distinct[name]])
+            if pairs_df is not None:
+                self.distinct[name] = pairs_df.drop_duplicates()
+
+        self.months = self.months.add(other.months, fill_value=0).astype('int64')
+        self.weeks = self.weeks.add(other.weeks, fill_value=0).astype('int64')
+
+        breeding_df = self._concat([self.breeding, other.breeding])
+        if breeding_df is not None:
+            self.breeding = breeding_df.groupby(level=[0, 1], sort=False).agg({'Records'  : 'sum',
+                                                                               'Counts'   : 'sum',
+                                                                               'Earliest' : 'min',
+                                                                               'Latest'   : 'max'})
+        squares_df = self._concat([self.breedingSquares, other.breedingSquares])
+        if squares_df is not None:
+            self.breedingSquares = squares_df.drop_duplicates()
+
+    def save(self, stateFilePath, fingerprint):
+        # Save the aggregates together with a fingerprint of the tables used to normalise
+        # the species they were built from
+        pd.to_pickle({'version'     : stateVersion,
+                      'fingerprint' : fingerprint,
+                      'aggregates'  : self}, stateFilePath)
+
+    @staticmethod
+    def load(stateFilePath, fingerprint):
+        # Load previously saved aggregates.  Returns None if the snapshot was written by a
+        # different version of this module or with different species normalisation tables,
+        # as the records it holds would then be summarised differently
+        snapshot = pd.read_pickle(stateFilePath)
+        if snapshot.get('version') != stateVersion or snapshot.get('fingerprint') != fingerprint:
+            return None
+        return snapshot['aggregates']
+
+    def speciesOrder(self):
+        # Species in the order they first appear when the input is sorted by BOU order and date
+        return pd.Index(self.first['Species'], name='Species')
+
+    def observedSquares(self):
+        return self.distinct['1km squares']['Value'].nunique()
+
+    def summarySheet(self, areaSquares):
+        # - Total number of records
+        summary = {'Summary': ['Input file contains {} records'.format(self.totalRecords)]}
+
+        # - Total number of species observed
+        totalSpecies = len(self.stats)
+        summary['Summary'].append('{} unique species names (NB sub species will be counted as different species and includes species beginning unidentified)'.format(totalSpecies))
+
+        # - Total number of discrete place names where observations were made
+        totalPlaces = self.distinct['Places']['Value'].nunique()
+        summary['Summary'].append('{} unique place names'.format(totalPlaces))
+
+        # - Total number of observers
+        totalObservers = self.distinct['Observers']['Value'].nunique()
+        summary['Summary'].append('{} unique observers'.format(totalObservers))
+
+        # - Total number of days in the year when species observations were made
+        totalDays = self.distinct['Days']['Value'].nunique()
+        summary['Summary'].append('{} unique days on which observations were made'.format(totalDays))
+
+        # - Total count for all species
+        summary['Summary'].append('{} individual birds (At least)'.format(self.totalCount))
+
+        # - Total number of 1km squares where observations were logged
+        totalSquares = self.observedSquares()
+        summary['Summary'].append('In {} unique 1km squares'.format(totalSquares))
+
+        # - Overall % coverage of 1km squares
+        pcentCoverage = totalSquares/int(areaSquares) * 100
+        summary['Summary'].append('Overall {}% of 1km squares had observations recorded in them'.format(pcentCoverage))
+
+        return pd.DataFrame(summary)
+
+    def speciesSheet(self):
+        order = self.speciesOrder()
+        totalSquares = self.observedSquares()
+        species_df = pd.DataFrame({'Records'     : self.stats['Records'].reindex(order).to_numpy(dtype='int64'),
+                                   'Places'      : self._distinctCount('Places', order),
+                                   'Observers'   : self._distinctCount('Observers', order),
+                                   'Days'        : self._distinctCount('Days', order),
+                                   'Total count' : self.stats['Total count'].reindex(order).to_numpy(),
+                                   '1km squares' : self._distinctCount('1km squares', order)}, index=order)
+        species_df['% 1km Squares'] = (species_df['1km squares'] / totalSquares * 100).map('{:.2f}'.format)
+        return species_df.reset_index()
+
+    def _distinctCount(self, name, order):
+        return self.distinct[name].groupby('Species').size().reindex(order, fill_value=0).to_numpy(dtype='int64')
+
+    def calendarSheet(self, period):
+        if period == 'week':
+            calendar_df = self.weeks.reindex(self.speciesOrder(), fill_value=0)
+            calendar_df.columns = ['Week {}'.format(week) for week in calendar_df.columns]
+        else:
+            calendar_df = self.months.reindex(self.speciesOrder(), fill_value=0)
+            calendar_df.columns = monthNames
+        return calendar_df.astype('int64').reset_index()
+
+    def breedingSheet(self, categories):
+        # Pivot the (species, breeding status) aggregates out into a block of columns per
+        # requested status
+        totalSquares = self.observedSquares()
+        stats_df = self.breeding[self.breeding.index.get_level_values('Status').isin(categories)].copy()
+        squares = self.breedingSquares.groupby(['Species', 'Status']).size()
+        stats_df['Squares'] = squares.reindex(stats_df.index, fill_value=0)
+        stats_df['Squares %'] = stats_df['Squares'] / totalSquares * 100
+        stats_df = stats_df.unstack('Status')
+
+        # species are listed in report order and every requested status gets a block of
+        # columns whether or not it has any records
+        order = self.speciesOrder()
+        order = order[order.isin(stats_df.index)]
+        stats_df = stats_df.reindex(index=order,
+                                    columns=pd.MultiIndex.from_product([stats_df.columns.levels[0], list(categories)]))
+
+        # statuses without any records for a species are reported as zero and date.min
+        breeding_df = pd.DataFrame({'Species': order.to_numpy()})
+        for status, label in categories.items():
+            present = stats_df[('Records', status)].notna().to_numpy()
+            breeding_df['{} Records'.format(label)] = stats_df[('Records', status)].fillna(0).to_numpy(dtype='int64')
+            breeding_df['{} Counts'.format(label)] = self._countValues(stats_df[('Counts', status)].fillna(0))
+            breeding_df['{} Squares'.format(label)] = stats_df[('Squares', status)].fillna(0).to_numpy(dtype='int64')
+            breeding_df['{} Squares %'.format(label)] = np.where(present, stats_df[('Squares %', status)].to_numpy(dtype=object), 0)
+            breeding_df['Earliest {}'.format(label)] = np.where(present, stats_df[('Earliest', status)].to_numpy(dtype=object), date.min)
+            breeding_df['Latest {}'.format(label)] = np.where(present, stats_df[('Latest', status)].to_numpy(dtype=object), date.min)
+        return breeding_df
+
+    def _countValues(self, counts):
+        # Unstacking promotes whole number counts to floats - put them back
+        values = counts.to_numpy()
+        if values.dtype.kind == 'f' and np.all(np.mod(values, 1) == 0):
+            return values.astype('int64')
+        return values
+
+    def summerVisitorsSheet(self, summerVisitors):
+        order = self.speciesOrder()
+        order = order[order.isin(summerVisitors)]
+        return pd.DataFrame({'Species'  : order.to_numpy(),
+                             'Earliest' : self.stats['Earliest'].reindex(order).to_numpy(),
+                             'Latest'   : self.stats['Latest'].reindex(order).to_numpy()})
+
+    def winterVisitorsSheet(self, winterVisitors):
+        # Winter visitors arrive in the second half of the year and leave in the first half.
+        # Species with no records in either half are reported as date.min
+        order = self.speciesOrder()
+        order = order[order.isin(winterVisitors)]
+        earliest = self.stats['Earliest Jul-Dec'].reindex(order)
+        latest = self.stats['Latest Jan-Jun'].reindex(order)
+        return pd.DataFrame({'Species'  : order.to_numpy(),
+                             'Earliest' : np.where(earliest.notna(), earliest.to_numpy(dtype=object), date.min),
+                             'Latest'   : np.where(latest.notna(), latest.to_numpy(dtype=object), date.min)})
@@ -0,0 +1,94 @@
+# Output backends for the sheets produced by speciesSummary.py
+#
+# - excel            pandas ExcelWriter with openpyxl, the original output.  The whole
+#                    workbook is built in memory before it is saved
+# - excel-streaming  xlsxwriter in constant memory mode.  Each row is written straight to
+#                    the file, all dates use DD/MM/YYYY and dates reported as date.min
+#                    (no records) are left blank
+# - parquet / csv    a folder containing one file per sheet for downstream tooling that
+#                    doesn't need Excel.  Dates are real dates with date.min written as null
+#                    (parquet output needs the optional pyarrow package)
+
+from datetime import date, datetime
+import math
+import pathlib
+import sys
+import numpy as np
+import pandas as pd
+
+outputFormats = ['excel', 'excel-streaming', 'parquet', 'csv']
+
+def writeSheets(sheets, outputFilePath, outputFormat):
+    # sheets maps sheet names onto dataframes, in the order they should be written
+    if outputFormat == 'excel':
+        writeExcel(sheets, outputFilePath)
+    elif outputFormat == 'excel-streaming':
+        writeExcelStreaming(sheets, outputFilePath)
+    else:
+        writeBundle(sheets, outputFilePath, outputFormat)
+
+def writeExcel(sheets, outputFilePath):
+    with pd.ExcelWriter(outputFilePath, engine='openpyxl',
+                        date_format='DD/MM/YYYY') as writer:
+        for sheetName, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheetName, index=False)
+
+def writeExcelStreaming(sheets, outputFilePath):
+    # pandas writes a sheet a column at a time, which constant memory mode can't accept, so
+    # the rows are written here in order
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(outputFilePath, {'constant_memory': True})
+    # same header style as pandas uses
+    headerFormat = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    dateFormat = workbook.add_format({'num_format': 'DD/MM/YYYY'})
+    for sheetName, df in sheets.items():
+        worksheet = workbook.add_worksheet(sheetName)
+        worksheet.write_row(0, 0, [str(column) for column in df.columns], headerFormat)
+        columns = [pythonValues(df[column]) for column in df.columns]
+        for rowNumber, row in enumerate(zip(*columns), start=1):
+            for columnNumber, value in enumerate(row):
+                if isinstance(value, datetime):
+                    worksheet.write_datetime(rowNumber, columnNumber, value, dateFormat)
+                elif isinstance(value, date):
+                    if value != date.min:
+                        worksheet.write_datetime(rowNumber, columnNumber, datetime.combine(value, datetime.min.time()), dateFormat)
+                elif isinstance(value, float) and math.isnan(value):
+                    continue
+                elif value is not None:
+                    worksheet.write(rowNumber, columnNumber, value)
+    workbook.close()
+
+def pythonValues(values):
+    # Convert a column to plain python values that xlsxwriter understands, NaT becomes None
+    # (object columns can hold NaT too, which would otherwise pass as a datetime)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return [None if pd.isna(value) else value.to_pydatetime() for value in values]
+    return [None if value is pd.NaT else value.item() if isinstance(value, np.generic) else value
+            for value in values.tolist()]
+
+def writeBundle(sheets, outputFolderPath, fileFormat):
+    folder = pathlib.Path(outputFolderPath)
+    folder.mkdir(parents=True, exist_ok=True)
+    for sheetName, df in sheets.items():
+        df = bundleFrame(df)
+        filePath = folder / '{}.{}'.format(sheetName.replace(' ', '_'), fileFormat)
+        if fileFormat == 'parquet':
+            try:
+                df.to_parquet(filePath, index=False)
+            except ImportError:
+                sys.exit('Parquet output needs the pyarrow package - pip install pyarrow')
+        else:
+            df.to_csv(filePath, index=False, date_format='%d/%m/%Y')
+
+def bundleFrame(df):
+    # Give mixed object columns a proper type - dates (with date.min as null) or numbers
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        values = df[column].dropna()
+        if len(values) > 0 and values.map(lambda value: isinstance(value, date)).all():
+            df[column] = pd.to_datetime(df[column].map(lambda value: None if type(value) is date and value == date.min else value))
+        elif len(values) > 0 and values.map(lambda value: isinstance(value, (int, float, np.number))).all():
+            df[column] = pd.to_numeric(df[column])
+    return df